@@ -2,13 +2,15 @@ import logging
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.core.cache import cache
-from django.conf import settings
+from django.utils import timezone
 from .serializers import UserSerializer, RegisterSerializer, LoginSerializer, ChangePasswordSerializer
 from .models import User
 from core.mixins import CacheResponseMixin, CacheInvalidationMixin
+from core.cache import USERS, PATIENTS, APPOINTMENTS, TREATMENTS
+from core.pagination import IdCursorPagination
+from appointments.models import DoctorLoad
+from appointments.permissions import IsDoctor
 
-CACHE_TTL = getattr(settings, 'CACHE_TTL', 300)
 logger = logging.getLogger(__name__)
 
 
@@ -18,23 +20,42 @@ class UserAdminViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mode
     serializer_class = UserSerializer
     http_method_names = ['get', 'put', 'patch', 'delete']
     cache_key_prefix = "user"
+    cache_namespaces_to_invalidate = (USERS, PATIENTS, APPOINTMENTS, TREATMENTS)
+    pagination_class = IdCursorPagination
 
     def get_serializer_class(self):
         if self.action in ['update', 'partial_update']:
             return RegisterSerializer
         return UserSerializer
 
-    def get_cache_keys_to_invalidate(self, instance):
-        return [
-            f"user_{instance.id}",
-            "all_users",
-            f"user_profile_{instance.id}"
-        ]
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        DoctorLoad.sync_doctor(serializer.instance, timezone.now().date())
+
+    @action(detail=False, methods=['get', 'patch'], permission_classes=[IsDoctor])
+    def availability(self, request):
+        """Today's load for the calling doctor; PATCH ``is_available`` to opt out of auto-assignment."""
+        day = timezone.now().date()
+        DoctorLoad.ensure_seeded(day)
+        load, _ = DoctorLoad.objects.get_or_create(doctor=request.user, day=day)
+        if request.method == 'PATCH':
+            is_available = request.data.get('is_available')
+            if not isinstance(is_available, bool):
+                return Response({'is_available': ['Must be true or false.']}, status=status.HTTP_400_BAD_REQUEST)
+            load.is_available = is_available
+            load.save(update_fields=['is_available'])
+        return Response({
+            'day': day,
+            'is_available': load.is_available,
+            'pending_appointments': load.pending_appointments,
+            'unseen_patients': load.unseen_patients,
+            'load': load.load,
+        })
 
     @action(detail=False, methods=['get', 'patch'], permission_classes=[permissions.IsAuthenticated])
     def profile(self, request):
         user = request.user
-        cache_key = f"user_profile_{user.id}"
+        cache_key = self.make_cache_key(f"user_profile_{user.id}")
 
         if request.method == 'PATCH':
             serializer = UserSerializer(user, data=request.data, partial=True)
@@ -44,16 +65,10 @@ class UserAdminViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mode
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-        profile_data = cache.get(cache_key)
-        if not profile_data:
-            serializer = UserSerializer(user)
-            profile_data = serializer.data
-            cache.set(cache_key, profile_data, timeout=CACHE_TTL)
-            logger.debug("accounts.profile cache miss for id=%s", user.id)
-        else:
-            logger.debug("accounts.profile cache hit for id=%s", user.id)
+        def build_payload():
+            return UserSerializer(user).data
 
-        return Response(profile_data, status=status.HTTP_200_OK)
+        return self.cached_response(cache_key, build_payload, f"accounts.profile id={user.id}")
 
     @action(detail=False, methods=['patch'], url_path='change-password', permission_classes=[permissions.IsAuthenticated])
     def change_password(self, request):
@@ -67,8 +82,7 @@ class UserAdminViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mode
 
 
 class AuthViewSet(CacheInvalidationMixin, viewsets.ViewSet):
-    def get_cache_keys_to_invalidate(self, instance):
-        return ["all_users"]
+    cache_namespaces_to_invalidate = (USERS,)
 
     @action(detail=False, methods=['post'], permission_classes=[permissions.IsAdminUser])
     def register(self, request):
@@ -76,6 +90,7 @@ class AuthViewSet(CacheInvalidationMixin, viewsets.ViewSet):
         if serializer.is_valid():
             user = serializer.save()
             self._invalidate_cache(user)
+            DoctorLoad.sync_doctor(user, timezone.now().date())
             return Response(UserSerializer(user).data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:50
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0002_initial'),
+        ('patients', '0002_patient_created_at_idx'),
+        ('treatments', '0002_remove_treatment_unique_treatment_per_patient_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['appointment_date'], name='appointment_date_idx'),
+        ),
+    ]
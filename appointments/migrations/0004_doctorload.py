@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:05
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0003_appointment_date_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorLoad',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('pending_appointments', models.IntegerField(default=0)),
+                ('unseen_patients', models.IntegerField(default=0)),
+                ('load', models.IntegerField(default=0)),
+                ('is_available', models.BooleanField(default=True)),
+                ('doctor', models.ForeignKey(limit_choices_to={'role': 'doctor'}, on_delete=django.db.models.deletion.CASCADE, related_name='loads', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['day', 'is_available', 'load'], name='doctor_load_pick_idx')],
+                'constraints': [models.UniqueConstraint(fields=('doctor', 'day'), name='unique_doctor_load_per_day')],
+            },
+        ),
+    ]
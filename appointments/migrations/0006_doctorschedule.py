@@ -0,0 +1,61 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:17
+
+import django.db.models.deletion
+from datetime import timedelta
+from django.conf import settings
+from django.db import migrations, models
+
+
+def set_follow_up_ends_at(apps, schema_editor):
+    # Existing follow-ups hold one default-length slot.
+    Appointment = apps.get_model('appointments', 'Appointment')
+    Appointment.objects.filter(appointment_type='follow_up').update(
+        ends_at=models.F('appointment_date') + timedelta(minutes=15)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0005_appointmentsequence'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorSchedule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weekday', models.PositiveSmallIntegerField(choices=[(0, 'Monday'), (1, 'Tuesday'), (2, 'Wednesday'), (3, 'Thursday'), (4, 'Friday'), (5, 'Saturday'), (6, 'Sunday')])),
+                ('start_time', models.TimeField()),
+                ('end_time', models.TimeField()),
+                ('slot_minutes', models.PositiveSmallIntegerField(default=15)),
+            ],
+            options={
+                'ordering': ['doctor', 'weekday', 'start_time'],
+            },
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='ends_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(set_follow_up_ends_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(condition=models.Q(('appointment_type', 'follow_up'), models.Q(('status', 'cancelled'), _negated=True)), fields=['doctor', 'appointment_date', 'ends_at'], name='appointment_doctor_span_idx'),
+        ),
+        migrations.AddField(
+            model_name='doctorschedule',
+            name='doctor',
+            field=models.ForeignKey(limit_choices_to={'role': 'doctor'}, on_delete=django.db.models.deletion.CASCADE, related_name='schedules', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='doctorschedule',
+            constraint=models.UniqueConstraint(fields=('doctor', 'weekday', 'start_time'), name='unique_doctor_shift'),
+        ),
+        migrations.AddConstraint(
+            model_name='doctorschedule',
+            constraint=models.CheckConstraint(condition=models.Q(('start_time__lt', models.F('end_time'))), name='shift_starts_before_it_ends'),
+        ),
+    ]
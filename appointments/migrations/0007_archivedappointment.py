@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0006_doctorschedule'),
+        ('patients', '0004_patient_search_fields'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('appointment_date', models.DateTimeField()),
+                ('ends_at', models.DateTimeField(blank=True, null=True)),
+                ('appointment_type', models.CharField(choices=[('initial', 'Initial Consultation'), ('follow_up', 'Follow-up Consultation')], max_length=20)),
+                ('type_seq', models.PositiveIntegerField(blank=True, null=True)),
+                ('case_followup_seq', models.PositiveIntegerField(blank=True, null=True)),
+                ('notes', models.TextField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('completed', 'Completed'), ('cancelled', 'Cancelled')], max_length=20)),
+                ('created_at', models.DateTimeField()),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('doctor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_doctor_appointments', to=settings.AUTH_USER_MODEL)),
+                ('initial_appointment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='follow_up_appointments', to='appointments.archivedappointment')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_appointments', to='patients.patient')),
+            ],
+            options={
+                'ordering': ['-appointment_date'],
+            },
+        ),
+    ]
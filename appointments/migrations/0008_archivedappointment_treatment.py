@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0007_archivedappointment'),
+        ('treatments', '0004_archivedtreatment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedappointment',
+            name='treatment',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='appointments', to='treatments.archivedtreatment'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedappointment',
+            index=models.Index(fields=['patient', 'appointment_date'], name='archived_patient_date_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+from django.db import migrations
+from django.db.models import Max
+
+TYPE_SEQ_SEQUENCES = {
+    'initial': 'appointments_type_seq_initial',
+    'follow_up': 'appointments_type_seq_follow_up',
+}
+
+
+def create_sequences(apps, schema_editor):
+    # Only PostgreSQL allocates type_seq from native sequences; each starts
+    # past every number already handed out, live, archived or reserved.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Appointment = apps.get_model('appointments', 'Appointment')
+    ArchivedAppointment = apps.get_model('appointments', 'ArchivedAppointment')
+    AppointmentSequence = apps.get_model('appointments', 'AppointmentSequence')
+    for appointment_type, sequence in TYPE_SEQ_SEQUENCES.items():
+        last = max(
+            model.objects.filter(appointment_type=appointment_type).aggregate(m=Max('type_seq'))['m'] or 0
+            for model in (Appointment, ArchivedAppointment)
+        )
+        reserved = AppointmentSequence.objects.filter(name=f"type_seq:{appointment_type}").first()
+        last = max(last, reserved.last_value if reserved else 0)
+        schema_editor.execute(f"CREATE SEQUENCE IF NOT EXISTS {sequence} START WITH {last + 1}")
+
+
+def drop_sequences(apps, schema_editor):
+    # Hand the counters back to the AppointmentSequence rows before dropping.
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    AppointmentSequence = apps.get_model('appointments', 'AppointmentSequence')
+    for appointment_type, sequence in TYPE_SEQ_SEQUENCES.items():
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(f"SELECT last_value, is_called FROM {sequence}")
+            last_value, is_called = cursor.fetchone()
+        counter, _ = AppointmentSequence.objects.get_or_create(name=f"type_seq:{appointment_type}")
+        counter.last_value = max(counter.last_value, last_value if is_called else last_value - 1)
+        counter.save(update_fields=['last_value'])
+        schema_editor.execute(f"DROP SEQUENCE IF EXISTS {sequence}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0008_archivedappointment_treatment'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_sequences, drop_sequences),
+    ]
@@ -1,5 +1,7 @@
-from django.db import models
-from django.db.models import Max, Q
+import heapq
+from collections import Counter
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import Max, Q, F, Count
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
@@ -7,6 +9,20 @@ from accounts.models import User
 from patients.models import Patient
 
 
+DEFAULT_SLOT_MINUTES = 15
+MAX_SLOT_MINUTES = 240
+
+# Appointments that occupy a doctor's calendar. Initial appointments are
+# walk-in queue entries and never hold a slot.
+SCHEDULED = Q(appointment_type='follow_up') & ~Q(status='cancelled')
+
+# Native sequences that hand out type_seq on PostgreSQL (migration 0009).
+TYPE_SEQ_SEQUENCES = {
+    'initial': 'appointments_type_seq_initial',
+    'follow_up': 'appointments_type_seq_follow_up',
+}
+
+
 class Appointment(models.Model):
     APPOINTMENT_TYPES = [
         ('initial', 'Initial Consultation'),
@@ -26,6 +42,8 @@ class Appointment(models.Model):
         User, on_delete=models.CASCADE, limit_choices_to={'role': 'doctor'}, related_name='doctor_appointments'
     )
     appointment_date = models.DateTimeField(default=timezone.now)
+    # End of the slot a scheduled follow-up holds; empty for initial appointments.
+    ends_at = models.DateTimeField(null=True, blank=True, editable=False)
     appointment_type = models.CharField(max_length=20, choices=APPOINTMENT_TYPES, default='initial')
 
     # Link follow-ups to their initial appointment
@@ -72,10 +90,25 @@ class Appointment(models.Model):
                 )
             ),
         ]
+        indexes = [
+            models.Index(fields=['appointment_date'], name='appointment_date_idx'),
+            models.Index(
+                fields=['doctor', 'appointment_date', 'ends_at'],
+                name='appointment_doctor_span_idx',
+                condition=SCHEDULED,
+            ),
+        ]
 
     def __str__(self):
         return f"{self.patient.first_name} - {self.get_appointment_type_display()} ({self.appointment_date.date()})"
 
+    @property
+    def load_key(self):
+        """``(doctor_id, day)`` this appointment counts towards in DoctorLoad."""
+        if self.status != 'pending' or self.doctor_id is None:
+            return None
+        return (self.doctor_id, self.appointment_date.date())
+
     @property
     def display_id(self):
         prefix = 'I' if self.appointment_type == 'initial' else 'F'
@@ -102,31 +135,344 @@ class Appointment(models.Model):
             if self.appointment_type == 'follow_up' and self.initial_appointment.appointment_type != 'initial':
                 raise ValidationError({'initial_appointment': 'Follow-up must reference an initial appointment.'})
 
+    @classmethod
+    def next_type_seq(cls, appointment_type):
+        """Reserve the next ``type_seq`` value for a type."""
+        return cls.next_type_seqs(appointment_type)[0]
+
+    @classmethod
+    def next_type_seqs(cls, appointment_type, count=1):
+        """Reserve ``count`` ``type_seq`` values for a type, in increasing order.
+
+        On PostgreSQL they come from a native sequence: ``nextval`` holds no
+        lock past the call, so concurrent registrations never wait on each
+        other, and numbers of rolled-back inserts are skipped. Elsewhere they
+        come from the ``AppointmentSequence`` row and are consecutive.
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT nextval(%s::regclass) FROM generate_series(1, %s)", [TYPE_SEQ_SEQUENCES[appointment_type], count]
+                )
+                return sorted(row[0] for row in cursor.fetchall())
+        first = AppointmentSequence.allocate(
+            f"type_seq:{appointment_type}",
+            count,
+            seed=lambda: max(
+                model.objects.filter(appointment_type=appointment_type).aggregate(m=Max('type_seq'))['m'] or 0
+                for model in (cls, ArchivedAppointment)
+            ),
+        )
+        return list(range(first, first + count))
+
+    @classmethod
+    def next_case_followup_seq(cls, initial_appointment_id, count=1):
+        """Reserve ``count`` consecutive follow-up numbers within one case; returns the first."""
+        return AppointmentSequence.allocate(
+            f"case_followup_seq:{initial_appointment_id}",
+            count,
+            seed=lambda: cls.objects.filter(
+                appointment_type='follow_up', initial_appointment_id=initial_appointment_id
+            ).aggregate(m=Max('case_followup_seq'))['m'],
+        )
+
     def _assign_type_seq_if_needed(self):
         if self.type_seq is None:
-            last = Appointment.objects.filter(
-                appointment_type=self.appointment_type
-            ).aggregate(m=Max('type_seq'))['m'] or 0
-            self.type_seq = last + 1
+            self.type_seq = Appointment.next_type_seq(self.appointment_type)
 
     def _assign_case_followup_seq_if_needed(self):
         if self.appointment_type == 'follow_up' and self.initial_appointment_id and self.case_followup_seq is None:
-            last_case = Appointment.objects.filter(
-                appointment_type='follow_up',
-                initial_appointment=self.initial_appointment
-            ).aggregate(m=Max('case_followup_seq'))['m'] or 0
-            self.case_followup_seq = last_case + 1
+            self.case_followup_seq = Appointment.next_case_followup_seq(self.initial_appointment_id)
+
+    def _loaded_relations(self):
+        return [
+            field.name for field in self._meta.concrete_fields
+            if field.is_relation and field.is_cached(self) and field.get_cached_value(self) is not None
+        ]
 
     def save(self, *args, **kwargs):
-        self.full_clean()
+        # Related objects the caller already loaded need no existence query, and
+        # the unique and check constraints are enforced by the database (clean()
+        # repeats the check constraint with a friendlier message).
+        self.full_clean(exclude=self._loaded_relations(), validate_unique=False, validate_constraints=False)
+
+        # Sequence numbers and the row are written in one transaction, so the
+        # sequence locks cover the insert and a failed insert leaves no gap.
+        with transaction.atomic(savepoint=False):
+            if self._state.adding:
+                self._assign_type_seq_if_needed()
+                self._assign_case_followup_seq_if_needed()
+            else:
+                if self.appointment_type == 'follow_up':
+                    if self.type_seq is None:
+                        self._assign_type_seq_if_needed()
+                    if self.case_followup_seq is None:
+                        self._assign_case_followup_seq_if_needed()
+            super().save(*args, **kwargs)
+
+
+class ArchivedAppointment(models.Model):
+    """An appointment of a closed case moved out of the hot table.
+
+    Same columns and ids as ``Appointment``; ``initial_appointment`` and
+    ``treatment`` point into the archive, since a case is archived whole with
+    its treatments (see the ``archive_appointments`` command).
+    """
+    id = models.BigIntegerField(primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='archived_appointments')
+    doctor = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_doctor_appointments')
+    appointment_date = models.DateTimeField()
+    ends_at = models.DateTimeField(null=True, blank=True)
+    appointment_type = models.CharField(max_length=20, choices=Appointment.APPOINTMENT_TYPES)
+    initial_appointment = models.ForeignKey(
+        'self', null=True, blank=True, on_delete=models.CASCADE, related_name='follow_up_appointments'
+    )
+    treatment = models.ForeignKey(
+        'treatments.ArchivedTreatment', null=True, blank=True, on_delete=models.CASCADE, related_name='appointments'
+    )
+    type_seq = models.PositiveIntegerField(null=True, blank=True)
+    case_followup_seq = models.PositiveIntegerField(null=True, blank=True)
+    notes = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=20, choices=Appointment.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    display_id = Appointment.display_id
+
+    class Meta:
+        ordering = ['-appointment_date']
+        indexes = [
+            models.Index(fields=['patient', 'appointment_date'], name='archived_patient_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.display_id} (archived)"
+
+
+class AppointmentSequence(models.Model):
+    """Last value handed out by a named appointment number sequence.
+
+    One row per case (``case_followup_seq:<initial id>``) and, except on
+    PostgreSQL where native sequences are used, per appointment type
+    (``type_seq:<type>``). Allocation increments the row under a row lock
+    held until the caller's transaction ends, so concurrent inserts never
+    draw the same number and no MAX() scan is needed.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    last_value = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name}: {self.last_value}"
+
+    @classmethod
+    def allocate(cls, name, count=1, seed=None):
+        """Reserve ``count`` consecutive values of ``name`` and return the first.
+
+        ``seed`` returns the highest value already in use and is only called
+        when the sequence row is first created.
+        """
+        # No savepoint: a failure here aborts the caller's transaction anyway.
+        with transaction.atomic(savepoint=False):
+            sequence = cls.objects.select_for_update().filter(name=name).first()
+            if sequence is None:
+                sequence = cls._create(name, (seed() if seed else None) or 0)
+            sequence.last_value += count
+            sequence.save(update_fields=['last_value'])
+            return sequence.last_value - count + 1
+
+    @classmethod
+    def _create(cls, name, last_value):
+        try:
+            with transaction.atomic():
+                return cls.objects.create(name=name, last_value=last_value)
+        except IntegrityError:
+            return cls.objects.select_for_update().get(name=name)
+
+
+class DoctorSchedule(models.Model):
+    """One working shift of a doctor on a weekday, cut into ``slot_minutes`` slots."""
+    WEEKDAYS = [
+        (0, 'Monday'),
+        (1, 'Tuesday'),
+        (2, 'Wednesday'),
+        (3, 'Thursday'),
+        (4, 'Friday'),
+        (5, 'Saturday'),
+        (6, 'Sunday'),
+    ]
+
+    doctor = models.ForeignKey(
+        User, on_delete=models.CASCADE, limit_choices_to={'role': 'doctor'}, related_name='schedules'
+    )
+    weekday = models.PositiveSmallIntegerField(choices=WEEKDAYS)
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    slot_minutes = models.PositiveSmallIntegerField(default=DEFAULT_SLOT_MINUTES)
+
+    class Meta:
+        ordering = ['doctor', 'weekday', 'start_time']
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'weekday', 'start_time'], name='unique_doctor_shift'),
+            models.CheckConstraint(name='shift_starts_before_it_ends', check=Q(start_time__lt=F('end_time'))),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor.username} {self.get_weekday_display()} {self.start_time}-{self.end_time}"
+
+
+class DoctorLoad(models.Model):
+    """A doctor's live workload for one day, used to auto-assign walk-ins.
+
+    ``load`` is the doctor's pending appointments plus unseen patients for
+    ``day``. The write paths keep it current through ``adjust`` instead of
+    counting per request, so the least-loaded doctor is the first row of an
+    index scan. Rows for a day are seeded from the tables on first use,
+    which also drops the rows of earlier days.
+    """
+    doctor = models.ForeignKey(
+        User, on_delete=models.CASCADE, limit_choices_to={'role': 'doctor'}, related_name='loads'
+    )
+    day = models.DateField()
+    pending_appointments = models.IntegerField(default=0)
+    unseen_patients = models.IntegerField(default=0)
+    load = models.IntegerField(default=0)
+    is_available = models.BooleanField(default=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['doctor', 'day'], name='unique_doctor_load_per_day'),
+        ]
+        indexes = [
+            models.Index(fields=['day', 'is_available', 'load'], name='doctor_load_pick_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor.username} {self.day}: {self.load}"
+
+    @classmethod
+    def assign(cls, day):
+        """Pick the least-loaded doctor for a new registration and count it.
+
+        Rows locked by concurrent registrations are skipped, so simultaneous
+        walk-ins spread across doctors instead of queueing on one row.
+        Unavailable doctors are only used when nobody is available.
+        """
+        with transaction.atomic():
+            cls.ensure_seeded(day)
+            for available_only in (True, False):
+                rows = cls.objects.filter(day=day).order_by('load', 'doctor_id')
+                if available_only:
+                    rows = rows.filter(is_available=True)
+                row = rows.select_for_update(skip_locked=True).first() or rows.select_for_update().first()
+                if row is not None:
+                    cls.adjust(row.doctor_id, day, pending=1, unseen=1)
+                    return row.doctor_id
+            return None
+
+    @classmethod
+    def assign_many(cls, day, count):
+        """Spread ``count`` registrations over the least-loaded doctors and count them."""
+        with transaction.atomic():
+            cls.ensure_seeded(day)
+            rows = list(cls.objects.select_for_update().filter(day=day).order_by('doctor_id'))
+            candidates = [row for row in rows if row.is_available] or rows
+            if not candidates:
+                return [None] * count
+            heap = [(row.load, row.doctor_id) for row in candidates]
+            heapq.heapify(heap)
+            assigned = []
+            for _ in range(count):
+                load, doctor_id = heapq.heappop(heap)
+                assigned.append(doctor_id)
+                heapq.heappush(heap, (load + 2, doctor_id))
+            for doctor_id, registrations in Counter(assigned).items():
+                cls.adjust(doctor_id, day, pending=registrations, unseen=registrations)
+            return assigned
+
+    @classmethod
+    def adjust(cls, doctor_id, day, pending=0, unseen=0):
+        """Apply a change in a doctor's counts; a no-op until the day is seeded."""
+        if doctor_id is None or not (pending or unseen):
+            return
+        cls.objects.filter(doctor_id=doctor_id, day=day).update(
+            pending_appointments=F('pending_appointments') + pending,
+            unseen_patients=F('unseen_patients') + unseen,
+            load=F('load') + pending + unseen,
+        )
+
+    @classmethod
+    def track(cls, before, after, counter):
+        """Move one unit of ``counter`` ('pending' or 'unseen') between load keys.
+
+        Keys are ``(doctor_id, day)`` or ``None`` when the row does not count,
+        as returned by ``Appointment.load_key`` and ``Patient.load_key``.
+        """
+        if before == after:
+            return
+        if before is not None:
+            cls.adjust(*before, **{counter: -1})
+        if after is not None:
+            cls.adjust(*after, **{counter: 1})
+
+    @classmethod
+    def ensure_seeded(cls, day):
+        """Create ``day``'s rows from the tables unless they exist, and drop older days.
+
+        Rows another request created meanwhile are kept as they are, since
+        they may already carry that request's ``adjust``.
+        """
+        if cls.objects.filter(day=day).exists():
+            return
+        with transaction.atomic():
+            # Only the current day is ever read, so earlier rows are dead weight.
+            cls.objects.filter(day__lt=day).delete()
+            cls.objects.bulk_create(cls._counted_rows(day), ignore_conflicts=True)
+
+    @classmethod
+    def recount(cls, day):
+        """Rebuild ``day``'s rows from the tables, keeping availability flags.
+
+        The day's rows are locked before counting, so writes that already
+        adjusted them commit first and are counted, and later ones wait and
+        apply their change on top of the new totals.
+        """
+        with transaction.atomic():
+            list(cls.objects.select_for_update().filter(day=day).values_list('pk', flat=True))
+            rows = cls._counted_rows(day)
+            cls.objects.filter(day=day).exclude(doctor_id__in=[row.doctor_id for row in rows]).delete()
+            cls.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['doctor', 'day'],
+                update_fields=['pending_appointments', 'unseen_patients', 'load'],
+            )
+
+    @classmethod
+    def _counted_rows(cls, day):
+        pending = dict(
+            Appointment.objects.filter(appointment_date__date=day, status='pending')
+            .order_by().values_list('doctor').annotate(n=Count('id'))
+        )
+        unseen = dict(
+            Patient.objects.filter(created_at__date=day, is_seen=False, assigned_doctor__isnull=False)
+            .order_by().values_list('assigned_doctor').annotate(n=Count('id'))
+        )
+        return [
+            cls(
+                doctor_id=doctor_id, day=day,
+                pending_appointments=pending.get(doctor_id, 0),
+                unseen_patients=unseen.get(doctor_id, 0),
+                load=pending.get(doctor_id, 0) + unseen.get(doctor_id, 0),
+            )
+            for doctor_id in User.objects.filter(role='doctor', is_active=True).values_list('id', flat=True)
+        ]
 
-        if self._state.adding:
-            self._assign_type_seq_if_needed()
-            self._assign_case_followup_seq_if_needed()
+    @classmethod
+    def sync_doctor(cls, user, day):
+        """Add or drop ``user``'s row after they join or leave the doctor roster."""
+        if user.role == 'doctor' and user.is_active:
+            if cls.objects.filter(day=day).exists():
+                cls.objects.get_or_create(doctor=user, day=day)
         else:
-            if self.appointment_type == 'follow_up':
-                if self.type_seq is None:
-                    self._assign_type_seq_if_needed()
-                if self.case_followup_seq is None:
-                    self._assign_case_followup_seq_if_needed()
-        super().save(*args, **kwargs)
+            cls.objects.filter(doctor=user, day=day).delete()
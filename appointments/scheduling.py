@@ -0,0 +1,110 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+
+from accounts.models import User
+from .models import Appointment, DoctorSchedule, DEFAULT_SLOT_MINUTES, MAX_SLOT_MINUTES, SCHEDULED
+
+MAX_AVAILABILITY_DAYS = 14
+# No booking is longer than the longest slot, so an overlapping one starts at
+# most this long before the range in question: a bounded index range scan.
+LONGEST_SPAN = timedelta(minutes=MAX_SLOT_MINUTES)
+
+
+def _at(day, time_of_day):
+    return timezone.make_aware(datetime.combine(day, time_of_day))
+
+
+def reserve_slot(doctor, start, exclude_pk=None):
+    """Check that ``doctor`` can take a follow-up at ``start`` and return when it ends.
+
+    Must run inside the transaction that saves the appointment: the doctor's
+    row stays locked until it commits, so two bookings for the same doctor
+    cannot both pass the overlap check. ``start`` must fall on the shift's
+    slot grid (its start plus whole slots). Doctors without a schedule can be
+    booked at any time in default-length slots.
+    """
+    User.objects.select_for_update().filter(pk=doctor.pk).values_list('pk', flat=True).first()
+    local = timezone.localtime(start)
+    schedule = list(DoctorSchedule.objects.filter(doctor=doctor))
+    if schedule:
+        shift = next(
+            (s for s in schedule if s.weekday == local.weekday() and s.start_time <= local.time() and
+             local + timedelta(minutes=s.slot_minutes) <= _at(local.date(), s.end_time)),
+            None,
+        )
+        if shift is None:
+            raise ValidationError({'appointment_date': "Outside the doctor's working hours."})
+        if (local - _at(local.date(), shift.start_time)) % timedelta(minutes=shift.slot_minutes):
+            raise ValidationError({
+                'appointment_date': f"Appointments start every {shift.slot_minutes} minutes from "
+                                    f"{shift.start_time:%H:%M} on this day.",
+            })
+        end = start + timedelta(minutes=shift.slot_minutes)
+    else:
+        end = start + timedelta(minutes=DEFAULT_SLOT_MINUTES)
+
+    clashes = Appointment.objects.filter(
+        SCHEDULED, doctor=doctor,
+        appointment_date__gt=start - LONGEST_SPAN, appointment_date__lt=end, ends_at__gt=start,
+    ).exclude(pk=exclude_pk)
+    if clashes.exists():
+        raise ValidationError({'appointment_date': "The doctor already has an appointment at this time."})
+    return end
+
+
+def free_slots(first_day, days=1, doctor_ids=None):
+    """Free slot start times per doctor and day, from ``first_day`` for ``days`` days.
+
+    Two queries whatever the range: the shifts, and the booked spans read
+    through the (doctor, start, end) index. Slots already past are left out.
+    """
+    schedules = DoctorSchedule.objects.filter(doctor__role='doctor', doctor__is_active=True)
+    if doctor_ids is not None:
+        schedules = schedules.filter(doctor_id__in=doctor_ids)
+    shifts_by_doctor = defaultdict(list)
+    for shift in schedules.order_by('doctor_id', 'weekday', 'start_time'):
+        shifts_by_doctor[shift.doctor_id].append(shift)
+    if not shifts_by_doctor:
+        return []
+
+    window_start = _at(first_day, datetime.min.time())
+    window_end = _at(first_day + timedelta(days=days), datetime.min.time())
+    booked = defaultdict(list)
+    spans = Appointment.objects.filter(
+        SCHEDULED, doctor_id__in=list(shifts_by_doctor),
+        appointment_date__gt=window_start - LONGEST_SPAN, appointment_date__lt=window_end, ends_at__gt=window_start,
+    ).order_by('doctor_id', 'appointment_date').values_list('doctor_id', 'appointment_date', 'ends_at')
+    for doctor_id, start, end in spans:
+        booked[doctor_id].append((start, end))
+
+    now = timezone.now()
+    results = []
+    for doctor_id, shifts in shifts_by_doctor.items():
+        doctor_spans = booked[doctor_id]
+        # Slots are visited in time order, so spans that ended before the
+        # current slot can be dropped for good.
+        position = 0
+        for offset in range(days):
+            day = first_day + timedelta(days=offset)
+            for shift in (s for s in shifts if s.weekday == day.weekday()):
+                step = timedelta(minutes=shift.slot_minutes)
+                slot, shift_end = _at(day, shift.start_time), _at(day, shift.end_time)
+                slots = []
+                while slot + step <= shift_end:
+                    while position < len(doctor_spans) and doctor_spans[position][1] <= slot:
+                        position += 1
+                    taken = position < len(doctor_spans) and doctor_spans[position][0] < slot + step
+                    if not taken and slot >= now:
+                        slots.append(slot)
+                    slot += step
+                results.append({
+                    'doctor': doctor_id,
+                    'date': day,
+                    'start_time': shift.start_time,
+                    'end_time': shift.end_time,
+                    'slot_minutes': shift.slot_minutes,
+                    'slots': slots,
+                })
+    return results
@@ -1,9 +1,18 @@
+from collections import Counter
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import transaction
+from django.db.models import FilteredRelation, Q
+from django.utils import timezone
 from rest_framework import serializers
-from .models import Appointment
+from .models import Appointment, ArchivedAppointment, DoctorLoad, DoctorSchedule, MAX_SLOT_MINUTES
+from .scheduling import reserve_slot, MAX_AVAILABILITY_DAYS
 from accounts.models import User
 from patients.models import Patient
+from patients.serializers import TimelineAppointmentSerializer, TimelineTreatmentSerializer
 from treatments.models import Treatment
 
+BULK_STATUS_LIMIT = 500
+
 
 class DoctorSerializer(serializers.ModelSerializer):
     class Meta:
@@ -17,27 +26,37 @@ class PatientSerializer(serializers.ModelSerializer):
         fields = ['id', 'first_name', 'last_name', 'gender', 'date_of_birth']
 
 
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Uses the object the parent serializer preloaded for this field, if any."""
+
+    def to_internal_value(self, data):
+        preloaded = getattr(self.parent, '_preloaded', {}).get(self.field_name)
+        if preloaded is not None and str(preloaded.pk) == str(data):
+            return preloaded
+        return super().to_internal_value(data)
+
+
 class AppointmentSerializer(serializers.ModelSerializer):
     patient = PatientSerializer(read_only=True)
-    patient_id = serializers.PrimaryKeyRelatedField(
+    patient_id = PreloadedPrimaryKeyRelatedField(
         queryset=Patient.objects.all(), source='patient', write_only=True
     )
 
     doctor = DoctorSerializer(read_only=True)
-    doctor_id = serializers.PrimaryKeyRelatedField(
+    doctor_id = PreloadedPrimaryKeyRelatedField(
         queryset=User.objects.filter(role='doctor'),
         source='doctor',
         write_only=True
     )
 
-    treatment = serializers.PrimaryKeyRelatedField(
+    treatment = PreloadedPrimaryKeyRelatedField(
         queryset=Treatment.objects.all(),
         required=False,
         allow_null=True
     )
 
     initial_appointment = serializers.PrimaryKeyRelatedField(read_only=True)
-    initial_appointment_id = serializers.PrimaryKeyRelatedField(
+    initial_appointment_id = PreloadedPrimaryKeyRelatedField(
         queryset=Appointment.objects.all(),
         source='initial_appointment',
         write_only=True,
@@ -51,12 +70,47 @@ class AppointmentSerializer(serializers.ModelSerializer):
         model = Appointment
         fields = [
             'id', 'display_id', 'patient', 'patient_id', 'doctor', 'doctor_id',
-            'appointment_date', 'appointment_type', 'initial_appointment',
+            'appointment_date', 'ends_at', 'appointment_type', 'initial_appointment',
             'initial_appointment_id', 'treatment', 'notes', 'status',
             'created_at', 'updated_at',
         ]
         read_only_fields = ('type_seq', 'case_followup_seq', 'created_at', 'updated_at')
 
+    def to_internal_value(self, data):
+        self._preloaded = self._preload_case(data)
+        return super().to_internal_value(data)
+
+    def _preload_case(self, data):
+        """Load a follow-up's initial appointment with its patient, doctor and treatment in one query.
+
+        The patient, doctor and treatment fields then reuse those objects
+        instead of each running a lookup, and validation compares them without
+        further queries. Treatments hang off initial appointments, so the
+        requested one is joined through the case when it belongs to it; any
+        other id is left for the field to look up.
+        """
+        pk = data.get('initial_appointment_id') if hasattr(data, 'get') else None
+        if pk in (None, ''):
+            return {}
+        queryset = Appointment.objects.select_related('patient', 'doctor')
+        treatment_pk = data.get('treatment')
+        if str(treatment_pk).isdigit():
+            queryset = queryset.annotate(
+                requested_treatment=FilteredRelation('treatments', condition=Q(treatments__pk=treatment_pk))
+            ).select_related('requested_treatment')
+        try:
+            initial_appt = queryset.get(pk=pk)
+        except (Appointment.DoesNotExist, TypeError, ValueError):
+            # Left for the field to report.
+            return {}
+        preloaded = {'initial_appointment_id': initial_appt, 'patient_id': initial_appt.patient}
+        if initial_appt.doctor.role == 'doctor':
+            preloaded['doctor_id'] = initial_appt.doctor
+        treatment = getattr(initial_appt, 'requested_treatment', None)
+        if treatment is not None:
+            preloaded['treatment'] = treatment
+        return preloaded
+
     def validate(self, attrs):
         appt_type = attrs.get('appointment_type') or getattr(self.instance, 'appointment_type', 'initial')
         
@@ -100,13 +154,240 @@ class AppointmentSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         if validated_data.get('appointment_type') == 'follow_up':
             validated_data['status'] = 'pending'
-        return super().create(validated_data)
+        with transaction.atomic():
+            self._book_slot(validated_data)
+            instance = super().create(validated_data)
+        # Nothing can have been treated under a brand-new appointment.
+        instance.case_treatment_id = None
+        return instance
+
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            self._book_slot(validated_data, instance)
+            return super().update(instance, validated_data)
+
+    def _book_slot(self, validated_data, instance=None):
+        """Give a follow-up that takes or moves to a slot its end time.
+
+        Runs in the saving transaction so the overlap check in
+        ``reserve_slot`` holds until the appointment is written.
+        """
+        def current(field, default=None):
+            return validated_data.get(field, getattr(instance, field, default))
+
+        if current('appointment_type', 'initial') != 'follow_up' or current('status', 'pending') == 'cancelled':
+            return
+        if instance is not None and instance.ends_at is not None and instance.status != 'cancelled' and all(
+            current(field) == getattr(instance, field) for field in ('appointment_date', 'doctor')
+        ):
+            return
+        start = validated_data.setdefault('appointment_date', current('appointment_date') or timezone.now())
+        try:
+            validated_data['ends_at'] = reserve_slot(current('doctor'), start, exclude_pk=getattr(instance, 'pk', None))
+        except DjangoValidationError as exc:
+            raise serializers.ValidationError(exc.message_dict)
 
     def to_representation(self, instance):
         rep = super().to_representation(instance)
         # If it's an initial appointment and has a treatment, include its ID
         if instance.appointment_type == 'initial' and not rep.get('treatment'):
-            treatment = instance.treatments.first()
-            if treatment:
-                rep['treatment'] = treatment.id
+            if hasattr(instance, 'case_treatment_id'):
+                # Annotated by AppointmentViewSet's queryset.
+                rep['treatment'] = instance.case_treatment_id
+            else:
+                treatment = instance.treatments.first()
+                if treatment:
+                    rep['treatment'] = treatment.id
         return rep
+
+
+class NormalizedAppointmentSerializer(AppointmentSerializer):
+    """Appointment rows that reference their patient and doctor by id.
+
+    Used by the normalized list shape, where patients and doctors are sent
+    once each in side tables.
+    """
+    patient = serializers.PrimaryKeyRelatedField(read_only=True)
+    doctor = serializers.PrimaryKeyRelatedField(read_only=True)
+
+
+class ArchivedAppointmentSerializer(serializers.ModelSerializer):
+    """Read-only shape of an archived appointment, matching ``AppointmentSerializer``."""
+    patient = PatientSerializer(read_only=True)
+    doctor = DoctorSerializer(read_only=True)
+    display_id = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = ArchivedAppointment
+        fields = [
+            'id', 'display_id', 'patient', 'doctor', 'appointment_date', 'ends_at', 'appointment_type',
+            'initial_appointment', 'treatment', 'notes', 'status', 'created_at', 'updated_at', 'archived_at',
+        ]
+        read_only_fields = fields
+
+    def to_representation(self, instance):
+        rep = super().to_representation(instance)
+        if instance.appointment_type == 'initial' and not rep.get('treatment'):
+            rep['treatment'] = getattr(instance, 'case_treatment_id', None)
+        return rep
+
+
+class CaseSummarySerializer(serializers.ModelSerializer):
+    """An initial appointment with the counters of its case.
+
+    Expects the ``follow_up_count``, ``last_visit`` and ``is_open`` annotations
+    of ``AppointmentViewSet.get_case_queryset``.
+    """
+    patient = PatientSerializer(read_only=True)
+    doctor = DoctorSerializer(read_only=True)
+    display_id = serializers.CharField(read_only=True)
+    treatment = serializers.IntegerField(source='case_treatment_id', read_only=True)
+    follow_up_count = serializers.IntegerField(read_only=True)
+    last_visit = serializers.DateTimeField(read_only=True)
+    is_open = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Appointment
+        fields = [
+            'id', 'display_id', 'patient', 'doctor', 'appointment_date', 'status', 'treatment',
+            'follow_up_count', 'last_visit', 'is_open',
+        ]
+        read_only_fields = fields
+
+
+class CaseSerializer(CaseSummarySerializer):
+    """A whole case: the initial appointment, its treatment and its follow-ups.
+
+    Expects ``treatments`` and ``follow_up_appointments`` (each with
+    ``doctor``) to be prefetched; it runs no queries itself. The treatment's
+    contents are shown only to the doctor who wrote it, so pass the request
+    in the context.
+    """
+    appointment = serializers.SerializerMethodField()
+    treatment = serializers.SerializerMethodField()
+    follow_ups = TimelineAppointmentSerializer(source='follow_up_appointments', many=True, read_only=True)
+
+    class Meta(CaseSummarySerializer.Meta):
+        fields = CaseSummarySerializer.Meta.fields + ['appointment', 'follow_ups']
+        read_only_fields = fields
+
+    def get_appointment(self, instance):
+        return TimelineAppointmentSerializer(instance).data
+
+    def get_treatment(self, instance):
+        treatments = list(instance.treatments.all())
+        return TimelineTreatmentSerializer(treatments[0], context=self.context).data if treatments else None
+
+
+class AppointmentQueueSerializer(serializers.ModelSerializer):
+    """Compact appointment shape used by the live queue board."""
+    display_id = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Appointment
+        fields = ['id', 'display_id', 'patient', 'doctor', 'appointment_date', 'appointment_type', 'status']
+
+
+class DoctorScheduleSerializer(serializers.ModelSerializer):
+    slot_minutes = serializers.IntegerField(min_value=5, max_value=MAX_SLOT_MINUTES, required=False)
+
+    class Meta:
+        model = DoctorSchedule
+        fields = ['id', 'weekday', 'start_time', 'end_time', 'slot_minutes']
+
+    def validate(self, attrs):
+        if attrs['start_time'] >= attrs['end_time']:
+            raise serializers.ValidationError({'end_time': 'A shift must end after it starts.'})
+        return attrs
+
+
+class DoctorWeekSerializer(serializers.Serializer):
+    """A doctor's full set of weekly shifts; saving replaces the previous set."""
+    shifts = DoctorScheduleSerializer(many=True)
+
+    def validate_shifts(self, shifts):
+        ordered = sorted(shifts, key=lambda s: (s['weekday'], s['start_time']))
+        for previous, shift in zip(ordered, ordered[1:]):
+            if previous['weekday'] == shift['weekday'] and shift['start_time'] < previous['end_time']:
+                raise serializers.ValidationError('Shifts on the same day cannot overlap.')
+        return ordered
+
+    def create(self, validated_data):
+        doctor = validated_data['doctor']
+        with transaction.atomic():
+            DoctorSchedule.objects.filter(doctor=doctor).delete()
+            return DoctorSchedule.objects.bulk_create(
+                DoctorSchedule(doctor=doctor, **shift) for shift in validated_data['shifts']
+            )
+
+
+class AvailabilityQuerySerializer(serializers.Serializer):
+    doctor = serializers.IntegerField(required=False)
+    date = serializers.DateField(required=False)
+    days = serializers.IntegerField(min_value=1, max_value=MAX_AVAILABILITY_DAYS, default=1)
+
+
+class CaseQuerySerializer(serializers.Serializer):
+    status = serializers.ChoiceField(choices=['open', 'closed'], required=False)
+    doctor = serializers.IntegerField(required=False)
+    patient = serializers.IntegerField(required=False)
+
+
+class AppointmentBulkStatusSerializer(serializers.Serializer):
+    """Cancel or complete many pending appointments in one transaction.
+
+    The appointments are read and locked with one query and checked against
+    the single-row rules in memory; the eligible ones are written with one
+    UPDATE. ``save()`` returns one result per id, in order, and ``updated``
+    holds the appointments that changed.
+    """
+    ids = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False, max_length=BULK_STATUS_LIMIT
+    )
+    status = serializers.ChoiceField(choices=['cancelled', 'completed'])
+
+    def validate_ids(self, ids):
+        return list(dict.fromkeys(ids))
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        target = validated_data['status']
+        queryset = Appointment.objects.filter(pk__in=validated_data['ids']).select_related('patient').only(
+            'status', 'appointment_type', 'type_seq', 'appointment_date', 'doctor_id', 'patient__is_seen'
+        )
+        if user.role == 'doctor':
+            queryset = queryset.filter(doctor=user)
+
+        with transaction.atomic():
+            found = {appointment.pk: appointment for appointment in queryset.select_for_update(of=('self',))}
+            results, self.updated = [], []
+            for pk in validated_data['ids']:
+                appointment = found.get(pk)
+                if appointment is None:
+                    results.append(self._error(pk, 'Not found.'))
+                elif appointment.status == target:
+                    results.append({'id': pk, 'status': 'unchanged'})
+                elif appointment.status != 'pending':
+                    results.append(self._error(pk, f"Appointment is already {appointment.status}."))
+                elif user.role == 'receptionist' and appointment.patient.is_seen:
+                    results.append(self._error(pk, "Cannot modify/cancel appointment - patient has already been seen"))
+                else:
+                    results.append({'id': pk, 'status': 'updated'})
+                    self.updated.append(appointment)
+            if self.updated:
+                self._apply(target)
+        return results
+
+    def _error(self, pk, detail):
+        return {'id': pk, 'status': 'error', 'errors': {'detail': detail}}
+
+    def _apply(self, target):
+        now = timezone.now()
+        Appointment.objects.filter(pk__in=[a.pk for a in self.updated]).update(status=target, updated_at=now)
+        # Every updated row was pending, so each leaves its doctor's pending count.
+        released = Counter(appointment.load_key for appointment in self.updated)
+        for (doctor_id, day), count in released.items():
+            DoctorLoad.adjust(doctor_id, day, pending=-count)
+        for appointment in self.updated:
+            appointment.status = target
+            appointment.updated_at = now
@@ -1,3 +1,402 @@
-from django.test import TestCase
+from datetime import datetime, time, timedelta
+from unittest import skipIf
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from accounts.models import User
+from core.cache import local_cache
+from patients.models import Patient
+from treatments.models import Treatment
+from .models import Appointment, ArchivedAppointment, DoctorLoad, DoctorSchedule
+from .scheduling import reserve_slot
+from .views import AppointmentViewSet
 
-# Create your tests here.
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AppointmentListQueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+        self.cases = 0
+
+    def add_cases(self, count):
+        # Each case is an initial appointment, its treatment and one follow-up.
+        for _ in range(count):
+            self.cases += 1
+            patient = Patient.objects.create(
+                first_name='Almaz', last_name='Tesfaye', gender='F',
+                contact_number=f'0911{self.cases:06d}', assigned_doctor=self.doctor,
+            )
+            initial = Appointment.objects.create(
+                patient=patient, doctor=self.doctor, appointment_date=timezone.now(),
+            )
+            treatment = Treatment.objects.create(
+                patient=patient, doctor=self.doctor, appointment=initial, notes='Seen.',
+            )
+            Appointment.objects.create(
+                patient=patient, doctor=self.doctor, appointment_date=timezone.now(),
+                appointment_type='follow_up', initial_appointment=initial, treatment=treatment,
+            )
+
+    def count_queries(self, url):
+        cache.clear()
+        local_cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()
+
+    def assert_constant_queries(self, url):
+        self.add_cases(2)
+        small, _ = self.count_queries(url)
+        self.add_cases(8)
+        large, payload = self.count_queries(url)
+        self.assertEqual(small, large)
+        return payload
+
+    def test_list_query_count_does_not_grow_with_rows(self):
+        payload = self.assert_constant_queries('/appointments/')
+        self.assertEqual(len(payload['results']['initial']), 10)
+
+    def test_today_query_count_does_not_grow_with_rows(self):
+        self.assert_constant_queries('/appointments/today/')
+
+    def test_initial_appointments_report_their_treatment(self):
+        self.add_cases(3)
+        _, payload = self.count_queries('/appointments/today/')
+        treatments = dict(Treatment.objects.values_list('appointment_id', 'id'))
+        for row in payload['initial']:
+            self.assertEqual(row['treatment'], treatments[row['id']])
+
+    def test_today_splits_rows_by_type_in_time_order(self):
+        self.add_cases(3)
+        _, payload = self.count_queries('/appointments/today/')
+        for appointment_type in ('initial', 'follow_up'):
+            rows = payload[appointment_type]
+            expected = Appointment.objects.filter(appointment_type=appointment_type).order_by('appointment_date')
+            self.assertEqual([row['id'] for row in rows], list(expected.values_list('id', flat=True)))
+        self.assertTrue(all(row['appointment_type'] == 'follow_up' for row in payload['follow_up']))
+
+    def test_normalized_shape_sends_each_patient_and_doctor_once(self):
+        self.add_cases(3)
+        nested_queries, nested = self.count_queries('/appointments/today/')
+        queries, payload = self.count_queries('/appointments/today/?shape=normalized')
+        self.assertEqual(queries, nested_queries)
+        self.assertEqual(len(payload['patients']), 3)
+        self.assertEqual([doctor['id'] for doctor in payload['doctors']], [self.doctor.pk])
+        for appointment_type in ('initial', 'follow_up'):
+            self.assertEqual(
+                [(row['id'], row['patient']) for row in payload[appointment_type]],
+                [(row['id'], row['patient']['id']) for row in nested[appointment_type]],
+            )
+
+    def test_case_listing_query_count_does_not_grow_with_rows(self):
+        payload = self.assert_constant_queries('/appointments/cases/')
+        self.assertEqual(len(payload['results']), 10)
+        self.assertTrue(all(row['follow_up_count'] == 1 and row['is_open'] for row in payload['results']))
+
+    def test_case_query_count_does_not_grow_with_follow_ups(self):
+        self.add_cases(1)
+        initial = Appointment.objects.get(appointment_type='initial')
+        url = f'/appointments/{initial.pk}/case/'
+        small, _ = self.count_queries(url)
+        treatment = initial.treatments.get()
+        for _ in range(5):
+            Appointment.objects.create(
+                patient=initial.patient, doctor=self.doctor, appointment_date=timezone.now(),
+                appointment_type='follow_up', initial_appointment=initial, treatment=treatment,
+            )
+        large, payload = self.count_queries(url)
+        self.assertEqual(small, large)
+        self.assertEqual(payload['follow_up_count'], 6)
+        self.assertEqual(len(payload['follow_ups']), 6)
+
+    def test_case_is_found_from_any_of_its_appointments(self):
+        self.add_cases(1)
+        follow_up = Appointment.objects.get(appointment_type='follow_up')
+        _, payload = self.count_queries(f'/appointments/{follow_up.pk}/case/')
+        self.assertEqual(payload['id'], follow_up.initial_appointment_id)
+
+    def test_case_with_a_malformed_id_is_not_found(self):
+        self.assertEqual(self.client.get('/appointments/abc/case/').status_code, 404)
+
+    def test_case_treatment_contents_are_only_shown_to_their_doctor(self):
+        self.add_cases(1)
+        initial = Appointment.objects.get(appointment_type='initial')
+        other_doctor = User.objects.create_user(username='dr_tigist', password='x', role='doctor')
+        Treatment.objects.filter(appointment=initial).update(prescription='Rest.')
+        url = f'/appointments/{initial.pk}/case/'
+
+        treatment = self.client.get(url).json()['treatment']
+        self.assertNotIn('notes', treatment)
+        self.assertNotIn('prescription', treatment)
+        self.client.force_authenticate(self.doctor)
+        treatment = self.client.get(url).json()['treatment']
+        self.assertEqual((treatment['notes'], treatment['prescription']), ('Seen.', 'Rest.'))
+        # The appointment stays with this doctor; the treatment was written by another.
+        Treatment.objects.filter(appointment=initial).update(doctor=other_doctor)
+        cache.clear()
+        local_cache.clear()
+        treatment = self.client.get(url).json()['treatment']
+        self.assertNotIn('notes', treatment)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CacheScopeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctors = [
+            User.objects.create_user(username=f'dr_{name}', password='x', role='doctor') for name in ('abebe', 'hanna')
+        ]
+        for number, doctor in enumerate(cls.doctors):
+            patient = Patient.objects.create(
+                first_name='Almaz', last_name='Tesfaye', gender='F', contact_number=f'091100000{number}',
+            )
+            Appointment.objects.create(patient=patient, doctor=doctor, appointment_date=timezone.now())
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+
+    def list_key(self, user, query):
+        request = Request(APIRequestFactory().get(f'/appointments/?{query}'))
+        request.user = user
+        return AppointmentViewSet(request=request, format_kwarg=None, action='list').get_list_cache_key(request)
+
+    def test_doctors_never_share_a_cached_list(self):
+        for doctor in self.doctors:
+            self.client.force_authenticate(doctor)
+            rows = self.client.get('/appointments/').json()['results']['initial']
+            self.assertEqual({row['doctor']['id'] for row in rows}, {doctor.pk})
+
+    def test_equivalent_query_strings_share_a_key(self):
+        doctor = self.doctors[0]
+        self.assertEqual(
+            self.list_key(doctor, 'status=pending&patient=1'), self.list_key(doctor, 'patient=1&status=pending')
+        )
+        self.assertNotEqual(
+            self.list_key(doctor, 'status=pending'), self.list_key(doctor, 'status=completed')
+        )
+        self.assertNotEqual(self.list_key(doctor, ''), self.list_key(self.doctors[1], ''))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FollowUpCreateQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_yonas', password='x', role='doctor')
+        cls.patient = Patient.objects.create(
+            first_name='Almaz', last_name='Tesfaye', gender='F', contact_number='0911000001', assigned_doctor=cls.doctor,
+        )
+        cls.initial = Appointment.objects.create(patient=cls.patient, doctor=cls.doctor)
+        cls.treatment = Treatment.objects.create(
+            patient=cls.patient, doctor=cls.doctor, appointment=cls.initial, notes='Seen.',
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor)
+        self.booked = 0
+
+    def create_follow_up(self):
+        self.booked += 1
+        when = timezone.now() + timedelta(days=1, minutes=15 * self.booked)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/appointments/', {
+                'patient_id': self.patient.pk, 'doctor_id': self.doctor.pk, 'appointment_type': 'follow_up',
+                'initial_appointment_id': self.initial.pk, 'treatment': self.treatment.pk, 'appointment_date': when,
+            }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(response.json()['treatment'], self.treatment.pk)
+        return [query['sql'] for query in queries]
+
+    def test_follow_up_create_loads_the_case_in_one_query(self):
+        self.create_follow_up()  # Creates the sequence counter rows.
+        queries = self.create_follow_up()
+        treatment_table = Treatment._meta.db_table
+        self.assertFalse([sql for sql in queries if sql.startswith(f'SELECT "{treatment_table}"')])
+        # Case lookup, doctor lock, schedule, clash check, two sequence
+        # reservations (type_seq is a single nextval() on PostgreSQL), insert
+        # and the load update, plus the savepoint pair.
+        self.assertEqual(len(queries), 11 if connection.vendor == 'postgresql' else 12)
+
+
+class AppointmentSequenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        cls.patient = Patient.objects.create(
+            first_name='Almaz', last_name='Tesfaye', gender='F', contact_number='0911000000',
+        )
+
+    def book(self, **fields):
+        return Appointment.objects.create(patient=self.patient, doctor=self.doctor, **fields)
+
+    def follow_up(self, initial):
+        treatment = Treatment.objects.get_or_create(
+            patient=self.patient, doctor=self.doctor, appointment=initial, defaults={'notes': 'Seen.'},
+        )[0]
+        return self.book(appointment_type='follow_up', initial_appointment=initial, treatment=treatment)
+
+    def test_reserved_blocks_are_increasing_and_unique(self):
+        first = self.book().type_seq
+        block = Appointment.next_type_seqs('initial', count=3)
+        after = self.book().type_seq
+        self.assertEqual(block, sorted(set(block)))
+        self.assertLess(first, block[0])
+        self.assertLess(block[-1], after)
+
+    @skipIf(connection.vendor == 'postgresql', "native sequences are seeded by migration 0009")
+    def test_counter_continues_after_archived_numbers(self):
+        now = timezone.now()
+        ArchivedAppointment.objects.create(
+            id=10_000, patient=self.patient, doctor=self.doctor, appointment_date=now, appointment_type='initial',
+            type_seq=40, status='completed', created_at=now, updated_at=now,
+        )
+        self.assertEqual([self.book().type_seq for _ in range(2)], [41, 42])
+
+    def test_follow_up_numbers_restart_per_case(self):
+        first_case, second_case = self.book(), self.book()
+        numbers = [self.follow_up(first_case).case_followup_seq for _ in range(2)]
+        self.assertEqual(numbers, [1, 2])
+        self.assertEqual(self.follow_up(second_case).case_followup_seq, 1)
+
+
+class DoctorLoadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.busy, cls.free = (
+            User.objects.create_user(username=name, password='x', role='doctor') for name in ('dr_busy', 'dr_free')
+        )
+        for number in range(2):
+            Patient.objects.create(
+                first_name='Almaz', last_name='Tesfaye', gender='F',
+                contact_number=f'091100000{number}', assigned_doctor=cls.busy,
+            )
+        cls.day = timezone.localdate()
+
+    def loads(self):
+        return dict(DoctorLoad.objects.filter(day=self.day).values_list('doctor_id', 'load'))
+
+    def test_assign_seeds_the_day_and_picks_the_least_loaded(self):
+        self.assertEqual(DoctorLoad.assign(self.day), self.free.pk)
+        self.assertEqual(self.loads(), {self.busy.pk: 2, self.free.pk: 2})
+
+    def test_unavailable_doctors_are_a_last_resort(self):
+        DoctorLoad.ensure_seeded(self.day)
+        DoctorLoad.objects.filter(doctor=self.free).update(is_available=False)
+        self.assertEqual(DoctorLoad.assign(self.day), self.busy.pk)
+        DoctorLoad.objects.filter(doctor=self.busy).update(is_available=False)
+        self.assertEqual(DoctorLoad.assign(self.day), self.free.pk)
+
+    def test_assign_many_spreads_by_load(self):
+        assigned = DoctorLoad.assign_many(self.day, 3)
+        self.assertEqual(assigned[0], self.free.pk)
+        self.assertEqual(sorted(assigned), sorted([self.free.pk, self.free.pk, self.busy.pk]))
+        self.assertEqual(self.loads(), {self.busy.pk: 4, self.free.pk: 4})
+
+    def test_seeding_keeps_todays_rows_and_drops_earlier_days(self):
+        DoctorLoad.objects.create(doctor=self.free, day=self.day - timedelta(days=1), load=9)
+        DoctorLoad.ensure_seeded(self.day)
+        DoctorLoad.adjust(self.free.pk, self.day, pending=1)
+        DoctorLoad.ensure_seeded(self.day)
+        self.assertEqual(self.loads(), {self.busy.pk: 2, self.free.pk: 1})
+        self.assertFalse(DoctorLoad.objects.filter(day__lt=self.day).exists())
+
+    def test_recount_rebuilds_counts_and_keeps_availability(self):
+        DoctorLoad.ensure_seeded(self.day)
+        DoctorLoad.objects.filter(doctor=self.busy).update(load=40, is_available=False)
+        DoctorLoad.recount(self.day)
+        row = DoctorLoad.objects.get(doctor=self.busy, day=self.day)
+        self.assertEqual((row.unseen_patients, row.load, row.is_available), (2, 2, False))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BulkStatusTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        cls.other_doctor = User.objects.create_user(username='dr_hanna', password='x', role='doctor')
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        cls.patient = Patient.objects.create(
+            first_name='Almaz', last_name='Tesfaye', gender='F', contact_number='0911000000',
+        )
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def book(self, doctor=None, status='pending'):
+        return Appointment.objects.create(
+            patient=self.patient, doctor=doctor or self.doctor, appointment_date=timezone.now(), status=status,
+        )
+
+    def post(self, user, ids, target):
+        self.client.force_authenticate(user)
+        return self.client.post('/appointments/bulk-status/', {'ids': ids, 'status': target}, format='json')
+
+    def test_partial_failure_updates_the_eligible_rows(self):
+        pending, other, cancelled = self.book(), self.book(self.other_doctor), self.book(status='cancelled')
+        DoctorLoad.ensure_seeded(timezone.localdate())
+        response = self.post(self.doctor, [pending.pk, other.pk, cancelled.pk, 999_999, pending.pk], 'completed')
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual((payload['updated'], payload['failed']), (1, 3))
+        self.assertEqual(
+            [(result['id'], result['status']) for result in payload['results']],
+            [(pending.pk, 'updated'), (other.pk, 'error'), (cancelled.pk, 'error'), (999_999, 'error')],
+        )
+        statuses = dict(Appointment.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[pk] for pk in (pending.pk, other.pk, cancelled.pk)], ['completed', 'pending', 'cancelled']
+        )
+        self.assertEqual(DoctorLoad.objects.get(doctor=self.doctor).pending_appointments, 0)
+
+    def test_all_rows_failing_is_a_bad_request(self):
+        Patient.objects.filter(pk=self.patient.pk).update(is_seen=True)
+        appointment = self.book()
+        response = self.post(self.receptionist, [appointment.pk], 'cancelled')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.json()['updated'], response.json()['failed']), (0, 1))
+        appointment.refresh_from_db()
+        self.assertEqual(appointment.status, 'pending')
+
+    def test_receptionists_cannot_complete(self):
+        self.assertEqual(self.post(self.receptionist, [self.book().pk], 'completed').status_code, 403)
+
+
+class ReserveSlotTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_hanna', password='x', role='doctor')
+        cls.day = timezone.localdate() + timedelta(days=1)
+        DoctorSchedule.objects.create(
+            doctor=cls.doctor, weekday=cls.day.weekday(),
+            start_time=time(9, 0), end_time=time(12, 0), slot_minutes=20,
+        )
+
+    def at(self, hour, minute, second=0):
+        return timezone.make_aware(datetime.combine(self.day, time(hour, minute, second)))
+
+    def test_start_on_the_slot_grid_is_reserved(self):
+        self.assertEqual(reserve_slot(self.doctor, self.at(9, 40)), self.at(10, 0))
+
+    def test_start_off_the_slot_grid_is_rejected(self):
+        for start in (self.at(9, 10), self.at(9, 40, 30)):
+            with self.subTest(start=start), self.assertRaises(ValidationError):
+                reserve_slot(self.doctor, start)
+
+    def test_start_outside_the_schedule_is_rejected(self):
+        for start in (self.at(8, 40), self.at(11, 50), self.at(12, 0)):
+            with self.subTest(start=start), self.assertRaises(ValidationError):
+                reserve_slot(self.doctor, start)
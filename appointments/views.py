@@ -2,28 +2,55 @@ import logging
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied
+from rest_framework.exceptions import PermissionDenied, ValidationError
 from django.utils import timezone
-from django.core.cache import cache
-from django.conf import settings
-from .models import Appointment
-from .serializers import AppointmentSerializer
+from django.db.models import BooleanField, Count, Exists, ExpressionWrapper, OuterRef, Prefetch, Q, Subquery
+from django.db.models.functions import Coalesce, Now
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from .models import Appointment, ArchivedAppointment, DoctorLoad, DoctorSchedule
+from .serializers import (
+    AppointmentSerializer, AppointmentQueueSerializer, NormalizedAppointmentSerializer,
+    PatientSerializer, DoctorSerializer, DoctorScheduleSerializer, DoctorWeekSerializer,
+    AvailabilityQuerySerializer, AppointmentBulkStatusSerializer, ArchivedAppointmentSerializer,
+    CaseSerializer, CaseSummarySerializer, CaseQuerySerializer,
+)
+from .scheduling import free_slots
 from .permissions import IsDoctor, IsReceptionist, IsAdminOrReceptionist
 from core.mixins import CacheResponseMixin, CacheInvalidationMixin
+from core.cache import APPOINTMENTS, TREATMENTS, patient_namespace
+from core.pagination import AppointmentDateCursorPagination
+from core.events import queue_event, publish_queue_events, APPOINTMENT_CANCELLED, APPOINTMENT_COMPLETED
+from treatments.models import Treatment, ArchivedTreatment
 
 
-CACHE_TTL = getattr(settings, 'CACHE_TTL', 300)
 logger = logging.getLogger(__name__)
 
+NORMALIZED_SHAPE = 'normalized'
+
+# Roles that may move appointments into each status in bulk, as they can one
+# at a time through cancel (receptionists) and update (doctors, own rows).
+BULK_STATUS_ROLES = {'cancelled': ('receptionist', 'doctor'), 'completed': ('doctor',)}
+
+
 class AppointmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelViewSet):
-    queryset = Appointment.objects.all().select_related('patient', 'doctor').order_by('-appointment_date')
+    # The case treatment id is read from a subquery so serializing a page
+    # costs the same number of queries whatever its size.
+    queryset = Appointment.objects.all().select_related('patient', 'doctor').annotate(
+        case_treatment_id=Subquery(Treatment.objects.filter(appointment=OuterRef('pk')).values('id')[:1])
+    ).order_by('-appointment_date')
     serializer_class = AppointmentSerializer
     cache_key_prefix = "appointment"
+    cache_namespaces_to_invalidate = (APPOINTMENTS, TREATMENTS)
+    cache_patient_id_attr = 'patient_id'
+    pagination_class = AppointmentDateCursorPagination
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update']:
+        if self.action in ['create', 'update', 'partial_update', 'schedule']:
             permission_classes = [IsDoctor]
-        elif self.action in ['list', 'retrieve', 'today']:
+        elif self.action == 'bulk_status':
+            permission_classes = [IsReceptionist | IsDoctor]
+        elif self.action in ['list', 'retrieve', 'today', 'availability', 'history', 'case', 'cases']:
             permission_classes = [IsAdminOrReceptionist | IsDoctor]
         elif self.action == 'destroy':
             permission_classes = [IsAdminOrReceptionist]
@@ -31,6 +58,16 @@ class AppointmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mo
             permission_classes = [permissions.IsAuthenticated]
         return [p() for p in permission_classes]
 
+    def get_serializer_class(self):
+        if self.action in ('list', 'today') and self.is_normalized_shape():
+            return NormalizedAppointmentSerializer
+        return super().get_serializer_class()
+
+    def is_normalized_shape(self):
+        # ``?shape=normalized`` sends each patient and doctor once, in side
+        # tables, instead of nesting them in every appointment.
+        return self.request.query_params.get('shape') == NORMALIZED_SHAPE
+
     def get_queryset(self):
         qs = super().get_queryset()
         user = self.request.user
@@ -38,63 +75,173 @@ class AppointmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mo
             qs = qs.filter(doctor=user)
         return qs
 
-    def list(self, request, *args, **kwargs):
+    def get_cache_scope(self, request):
         user = request.user
-        is_doctor = getattr(user, 'role', None) == 'doctor'
-        cache_key = f"appointments_list_{'doctor_' + str(user.id) if is_doctor else 'all'}"
-        
-        cached = cache.get(cache_key)
-        if cached:
-            logger.debug("appointments.list cache hit for user=%s", user.id)
-            return Response(cached)
+        if getattr(user, 'role', None) == 'doctor':
+            return f"_doctor_{user.id}"
+        return "_all"
+
+    def get_list_cache_key(self, request):
+        return f"appointments_list{self.get_cache_scope(request)}{self.get_query_cache_suffix(request)}"
 
-        logger.debug("appointments.list cache miss for user=%s; rebuilding payload", user.id)
-        qs = self.get_queryset()
-        payload = self._build_grouped_payload(qs)
-        cache.set(cache_key, payload, timeout=CACHE_TTL)
-        return Response(payload)
+    def get_today_cache_key(self, request, day):
+        shape = f"_{NORMALIZED_SHAPE}" if self.is_normalized_shape() else ""
+        return f"appointments_today{self.get_cache_scope(request)}_{day.isoformat()}{shape}"
 
     @action(detail=False, methods=['get'])
     def today(self, request):
         today_date = timezone.now().date()
         user = request.user
-        is_doctor = getattr(user, 'role', None) == 'doctor'
-        
-        cache_key = f"appointments_today_{'doctor_' + str(user.id) if is_doctor else 'all'}_{today_date.isoformat()}"
+        cache_key = self.make_cache_key(self.get_today_cache_key(request, today_date))
 
-        cached = cache.get(cache_key)
-        if cached:
-            logger.debug("appointments.today cache hit for user=%s", user.id)
-            return Response(cached)
+        def build_payload():
+            return self._build_grouped_payload(self.get_today_queryset(today_date))
 
-        logger.debug("appointments.today cache miss for user=%s; rebuilding payload", user.id)
-        
-        qs = self.get_queryset().filter(appointment_date__date=today_date)
-        qs = qs.order_by('appointment_date')
-        payload = self._build_grouped_payload(qs)
-        cache.set(cache_key, payload, timeout=CACHE_TTL)
-        return Response(payload)
+        return self.cached_response(cache_key, build_payload, f"appointments.today user={user.id}")
+
+    @action(detail=False, methods=['get', 'put'])
+    def schedule(self, request):
+        """The calling doctor's weekly shifts; PUT ``{"shifts": [...]}`` replaces them."""
+        if request.method == 'PUT':
+            serializer = DoctorWeekSerializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+            serializer.save(doctor=request.user)
+        shifts = DoctorSchedule.objects.filter(doctor=request.user)
+        return Response({'shifts': DoctorScheduleSerializer(shifts, many=True).data})
+
+    @action(detail=False, methods=['get'])
+    def availability(self, request):
+        """Free follow-up slots by doctor and day: ``?doctor=&date=&days=``."""
+        params = AvailabilityQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        doctor = params.validated_data.get('doctor')
+        first_day = params.validated_data.get('date') or timezone.localdate()
+        days = params.validated_data['days']
+        results = free_slots(first_day, days, doctor_ids=None if doctor is None else [doctor])
+        return Response({'date': first_day, 'days': days, 'results': results})
+
+    @action(detail=False, methods=['get'])
+    def history(self, request):
+        """All of a patient's appointments, current and archived: ``?patient=<id>``."""
+        patient_id = request.query_params.get('patient', '')
+        if not patient_id.isdigit():
+            raise ValidationError({'patient': 'A patient id is required.'})
+        # The patient's namespace is bumped by their writes and by archiving.
+        cache_key = self.make_cache_key(
+            f"appointments_history{self.get_cache_scope(request)}_{patient_id}", namespace=patient_namespace(patient_id)
+        )
+
+        def build_payload():
+            current = list(self.get_queryset().filter(patient_id=patient_id))
+            archived = list(self.get_archived_queryset().filter(patient_id=patient_id))
+            rows = [dict(row, archived_at=None) for row in AppointmentSerializer(current, many=True).data]
+            rows += ArchivedAppointmentSerializer(archived, many=True).data
+            grouped = {'initial': [], 'follow_up': []}
+            for appointment, row in sorted(
+                zip(current + archived, rows), key=lambda pair: pair[0].appointment_date, reverse=True
+            ):
+                grouped[appointment.appointment_type].append(row)
+            return grouped
+
+        return self.cached_response(cache_key, build_payload, f"appointments.history patient={patient_id}")
+
+    @action(detail=True, methods=['get'])
+    def case(self, request, pk=None):
+        """The case an appointment belongs to, whichever of its appointments ``pk`` is."""
+        if not str(pk).isdigit():
+            raise Http404
+        cache_key = self.make_cache_key(f"appointment_case_{pk}{self.get_cache_scope(request)}")
+
+        def build_payload():
+            case_id = Appointment.objects.filter(pk=pk).values(case_id=Coalesce('initial_appointment_id', 'id'))
+            queryset = self.get_case_queryset().prefetch_related(
+                Prefetch('treatments', queryset=Treatment.objects.select_related('doctor')),
+                Prefetch(
+                    'follow_up_appointments',
+                    queryset=Appointment.objects.select_related('doctor').order_by('appointment_date', 'id'),
+                ),
+            )
+            case = get_object_or_404(queryset, pk__in=case_id)
+            return CaseSerializer(case, context=self.get_serializer_context()).data
+
+        return self.cached_response(cache_key, build_payload, f"appointments.case id={pk}")
+
+    @action(detail=False, methods=['get'])
+    def cases(self, request):
+        """Cases with their counters, newest first: ``?status=open|closed&doctor=&patient=``."""
+        params = CaseQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        cache_key = self.make_cache_key(
+            f"appointments_cases{self.get_cache_scope(request)}{self.get_query_cache_suffix(request)}"
+        )
+
+        def build_payload():
+            queryset = self.get_case_queryset()
+            filters = params.validated_data
+            if 'status' in filters:
+                queryset = queryset.filter(is_open=filters['status'] == 'open')
+            if 'doctor' in filters:
+                queryset = queryset.filter(doctor_id=filters['doctor'])
+            if 'patient' in filters:
+                queryset = queryset.filter(patient_id=filters['patient'])
+            page = self.paginate_queryset(queryset)
+            return self.get_paginated_response(CaseSummarySerializer(page, many=True).data).data
+
+        return self.cached_response(cache_key, build_payload, f"appointments.cases user={request.user.id}")
+
+    def get_case_queryset(self):
+        """Initial appointments annotated with the counters of their case.
+
+        The counters are correlated subqueries over the follow-up index, so a
+        page of cases is a single query whatever the length of each chain.
+        A case is open while any of its appointments is pending; its last
+        visit is the latest appointment in it that is neither cancelled nor
+        still ahead.
+        """
+        follow_ups = Appointment.objects.filter(initial_appointment=OuterRef('pk')).order_by()
+        visits = Appointment.objects.filter(
+            Q(pk=OuterRef('pk')) | Q(initial_appointment=OuterRef('pk')), appointment_date__lte=Now()
+        ).exclude(status='cancelled')
+        return self.get_queryset().filter(appointment_type='initial').annotate(
+            follow_up_count=Coalesce(
+                Subquery(follow_ups.values('initial_appointment').annotate(count=Count('pk')).values('count')), 0
+            ),
+            last_visit=Subquery(visits.order_by('-appointment_date').values('appointment_date')[:1]),
+            is_open=ExpressionWrapper(
+                Q(status='pending') | Q(Exists(follow_ups.filter(status='pending'))), output_field=BooleanField()
+            ),
+        )
+
+    def get_archived_queryset(self):
+        qs = ArchivedAppointment.objects.select_related('patient', 'doctor').annotate(
+            case_treatment_id=Subquery(ArchivedTreatment.objects.filter(appointment=OuterRef('pk')).values('id')[:1])
+        )
+        if getattr(self.request.user, 'role', None) == 'doctor':
+            qs = qs.filter(doctor=self.request.user)
+        return qs
+
+    def get_today_queryset(self, day):
+        return self.get_queryset().filter(appointment_date__date=day).order_by('appointment_date')
 
     def _build_grouped_payload(self, qs):
-        initial_qs = qs.filter(appointment_type='initial')
-        follow_qs = qs.filter(appointment_type='follow_up')
-        return {
-            'initial': self.get_serializer(initial_qs, many=True).data,
-            'follow_up': self.get_serializer(follow_qs, many=True).data
-        }
+        # One query, partitioned by type in Python.
+        return self.group_appointment_rows(list(qs))
 
-    def get_cache_keys_to_invalidate(self, instance):
-        keys = ["all_appointments", "appointments_list_all"]
-        if instance.doctor:
-            keys.append(f"appointments_list_doctor_{instance.doctor.id}")
+    def serialize_rows(self, rows):
+        # List pages keep the grouped shape of the unpaginated payload.
+        return self.group_appointment_rows(rows)
 
-        appt_date = getattr(instance, 'appointment_date', None)
-        if appt_date:
-            date_str = appt_date.date().isoformat()
-            if instance.doctor:
-                keys.append(f"appointments_today_doctor_{instance.doctor.id}_{date_str}")
-            keys.append(f"appointments_today_all_{date_str}")
-        return keys
+    def group_appointment_rows(self, rows):
+        grouped = {
+            'initial': self.get_serializer([a for a in rows if a.appointment_type == 'initial'], many=True).data,
+            'follow_up': self.get_serializer([a for a in rows if a.appointment_type == 'follow_up'], many=True).data
+        }
+        if self.is_normalized_shape():
+            patients = {a.patient_id: a.patient for a in rows}
+            doctors = {a.doctor_id: a.doctor for a in rows}
+            grouped['patients'] = PatientSerializer(list(patients.values()), many=True).data
+            grouped['doctors'] = DoctorSerializer(list(doctors.values()), many=True).data
+        return grouped
 
     def _check_can_modify(self, appointment):
         if hasattr(self.request.user, 'role') and self.request.user.role == 'receptionist':
@@ -106,12 +253,58 @@ class AppointmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mo
         appointment = self.get_object()
         self._check_can_modify(appointment)
         
+        load_key = appointment.load_key
         appointment.status = 'cancelled'
         appointment.save()
+        DoctorLoad.track(load_key, appointment.load_key, 'pending')
         self._invalidate_cache(appointment)
+        publish_queue_events(status_event(appointment))
         
         return Response(self.get_serializer(appointment).data)
 
+    @action(detail=False, methods=['post'], url_path='bulk-status')
+    def bulk_status(self, request):
+        serializer = AppointmentBulkStatusSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        target = serializer.validated_data['status']
+        if request.user.role not in BULK_STATUS_ROLES[target]:
+            raise PermissionDenied(f"You cannot mark appointments as {target}.")
+        results = serializer.save()
+        for appointment in serializer.updated:
+            self._invalidate_cache(appointment)
+        publish_queue_events(*(status_event(appointment) for appointment in serializer.updated))
+        updated = len(serializer.updated)
+        failed = sum(1 for result in results if result['status'] == 'error')
+        return Response(
+            {'updated': updated, 'failed': failed, 'results': results},
+            status=status.HTTP_400_BAD_REQUEST if failed and not updated else status.HTTP_200_OK,
+        )
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        DoctorLoad.track(None, serializer.instance.load_key, 'pending')
+
+    def perform_update(self, serializer):
+        previous_status = serializer.instance.status
+        load_key = serializer.instance.load_key
+        super().perform_update(serializer)
+        DoctorLoad.track(load_key, serializer.instance.load_key, 'pending')
+        if serializer.instance.status != previous_status:
+            publish_queue_events(status_event(serializer.instance))
+
     def perform_destroy(self, instance):
         self._check_can_modify(instance)
+        load_key = instance.load_key
         super().perform_destroy(instance)
+        DoctorLoad.track(load_key, None, 'pending')
+
+
+STATUS_EVENTS = {'cancelled': APPOINTMENT_CANCELLED, 'completed': APPOINTMENT_COMPLETED}
+
+
+def status_event(appointment):
+    """Queue-board event for an appointment that just changed status, if any."""
+    event = STATUS_EVENTS.get(appointment.status)
+    if event is None:
+        return None
+    return queue_event(event, {'appointment': AppointmentQueueSerializer(appointment).data}, appointment.doctor_id)
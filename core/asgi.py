@@ -12,5 +12,9 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
+# This entry point serves the long-lived /queue/stream/ connections. Under
+# ASGI each request runs in a fresh thread, so persistent DB connections would
+# pile up instead of being reused.
+os.environ.setdefault('DB_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
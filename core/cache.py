@@ -0,0 +1,291 @@
+import json
+import time
+import logging
+import threading
+from functools import partial
+from collections import OrderedDict, namedtuple
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from core.metrics import cache_metrics
+
+logger = logging.getLogger(__name__)
+
+PATIENTS = 'patients'
+APPOINTMENTS = 'appointments'
+TREATMENTS = 'treatments'
+PAYMENTS = 'payments'
+USERS = 'users'
+
+LOCAL_CACHE_MAX_BYTES = getattr(settings, 'LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024)
+LOCAL_CACHE_TTL = getattr(settings, 'LOCAL_CACHE_TTL', 30)
+NAMESPACE_VERSION_LOCAL_TTL = getattr(settings, 'NAMESPACE_VERSION_LOCAL_TTL', 0)
+PATIENT_NAMESPACE_PREFIX = 'patient_'
+# Per-patient version keys expire instead of piling up one per patient. Twice
+# the entry TTL keeps a version alive past every entry written under it; an
+# expired key is reseeded from the clock, so it only costs a cache miss.
+PATIENT_NAMESPACE_VERSION_TTL = 2 * getattr(settings, 'CACHE_TTL', 300)
+# Version entries are sized 1, so this bounds how many namespaces are held.
+NAMESPACE_VERSION_LOCAL_MAX = 10000
+
+# Serializers that can store bytes as-is; the JSON serializer cannot.
+BINARY_CACHE_VALUES = getattr(settings, 'CACHE_SERIALIZER', 'json') in ('msgpack', 'pickle')
+
+RenderedEntry = namedtuple('RenderedEntry', ['body', 'content_type', 'length'])
+
+
+class LocalLRUCache:
+    """Per-process LRU bounded by the encoded size of its entries.
+
+    Keys are expected to carry a namespace version (see ``versioned_key``), so
+    a bump in Redis makes every worker's local copy unreachable on its next
+    lookup; the local TTL only bounds how long an unreachable entry lingers.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, size):
+        if self.max_bytes <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._pop(oldest)
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_bytes -= entry[1]
+
+
+local_cache = LocalLRUCache(LOCAL_CACHE_MAX_BYTES, LOCAL_CACHE_TTL)
+# Namespace versions read from Redis, optionally held for
+# NAMESPACE_VERSION_LOCAL_TTL seconds so a cache lookup is one round trip
+# instead of two. Off by default: with a TTL, bumps from this worker take
+# effect at once but bumps from other workers only within that window.
+local_versions = LocalLRUCache(NAMESPACE_VERSION_LOCAL_MAX, NAMESPACE_VERSION_LOCAL_TTL)
+
+
+def _version_key(namespace):
+    return f"ns_version_{namespace}"
+
+
+def _initial_version():
+    # Seed from the clock so a version key that was evicted never restarts at a
+    # generation that may still have live entries under it.
+    return int(time.time() * 1000)
+
+
+def _version_timeout(namespace):
+    return PATIENT_NAMESPACE_VERSION_TTL if namespace.startswith(PATIENT_NAMESPACE_PREFIX) else None
+
+
+def metrics_label(namespace):
+    # One series for all per-patient namespaces instead of one per patient.
+    return 'patient' if namespace.startswith(PATIENT_NAMESPACE_PREFIX) else namespace
+
+
+def get_namespace_version(namespace):
+    key = _version_key(namespace)
+    reuse = local_versions.ttl > 0
+    version = local_versions.get(key) if reuse else None
+    if version is not None:
+        return version
+    version = cache.get(key)
+    if version is None:
+        version = _initial_version()
+        if not cache.add(key, version, timeout=_version_timeout(namespace)):
+            version = cache.get(key) or version
+    if reuse:
+        local_versions.set(key, version, 1)
+    return version
+
+
+def patient_namespace(patient_id):
+    """Namespace of entries built from one patient's records (e.g. the timeline)."""
+    return f"{PATIENT_NAMESPACE_PREFIX}{patient_id}"
+
+
+def versioned_key(namespace, key):
+    return f"{namespace}:v{get_namespace_version(namespace)}:{key}"
+
+
+def _redis_client():
+    client = getattr(cache, 'client', None)
+    get_client = getattr(client, 'get_client', None)
+    return get_client(write=True) if get_client else None
+
+
+def bump_namespaces(*namespaces):
+    """Advance the version of every namespace in one round-trip where possible."""
+    namespaces = sorted(set(namespaces))
+    if not namespaces:
+        return
+    for namespace in namespaces:
+        local_versions.delete(_version_key(namespace))
+    started = time.perf_counter()
+    client = _redis_client()
+    if client is not None:
+        # SET NX seeds a missing (evicted) counter from the clock, as
+        # get_namespace_version would, before INCR advances it. Expiring
+        # counters get their TTL renewed on every bump.
+        pipe = client.pipeline(transaction=False)
+        for namespace in namespaces:
+            key = cache.make_key(_version_key(namespace))
+            timeout = _version_timeout(namespace)
+            pipe.set(key, _initial_version(), nx=True, ex=timeout)
+            pipe.incr(key)
+            if timeout:
+                pipe.expire(key, timeout)
+        try:
+            pipe.execute()
+        except Exception:
+            logger.warning("Failed to bump cache namespaces %s", namespaces, exc_info=True)
+            return
+    else:
+        for namespace in namespaces:
+            key = _version_key(namespace)
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, _initial_version(), timeout=_version_timeout(namespace))
+    elapsed = time.perf_counter() - started
+    for namespace in namespaces:
+        cache_metrics.record(metrics_label(namespace), 'invalidate', elapsed)
+    logger.debug("Bumped cache namespaces: %s", namespaces)
+
+
+def bump_namespaces_on_commit(*namespaces):
+    """Bump ``namespaces`` once the current transaction commits (or now, outside one)."""
+    if namespaces:
+        transaction.on_commit(partial(bump_namespaces, *namespaces))
+
+
+def _record(key, operation, started, size=None):
+    # Keys look like "<namespace>:v<version>:<base>" or "<namespace>:stale:<base>";
+    # last-good-copy lookups are reported separately from regular ones.
+    namespace, _, rest = key.partition(':')
+    if rest.startswith('stale:'):
+        operation = f"stale_{operation}"
+    cache_metrics.record(metrics_label(namespace), operation, time.perf_counter() - started, size)
+
+
+def get_cached(key, local=True):
+    """Look ``key`` up in the local tier, then in Redis."""
+    started = time.perf_counter()
+    data = local_cache.get(key) if local else None
+    if data is not None:
+        _record(key, 'local_hit', started)
+        return data
+    stored = cache.get(key)
+    if not isinstance(stored, dict) or 'payload' not in stored:
+        _record(key, 'miss', started)
+        return None
+    data = stored['payload']
+    _record(key, 'hit', started)
+    if local:
+        local_cache.set(key, data, stored['length'])
+    return data
+
+
+def set_cached(key, data, timeout, local=True):
+    # Keep a detached, JSON-shaped copy locally so local hits look exactly like
+    # Redis hits and do not pin serializers or querysets in memory. The encoded
+    # length is stored with it, so a Redis hit can size its local copy
+    # without encoding it again.
+    started = time.perf_counter()
+    encoded = json.dumps(data, cls=DjangoJSONEncoder)
+    data = json.loads(encoded)
+    cache.set(key, {'payload': data, 'length': len(encoded)}, timeout=timeout)
+    if local:
+        local_cache.set(key, data, len(encoded))
+    _record(key, 'set', started, len(encoded))
+    return data
+
+
+def _rendered_key(key):
+    return f"{key}:rendered"
+
+
+def get_rendered(key, local=True):
+    """Return the cached ``RenderedEntry`` for ``key`` or ``None``."""
+    started = time.perf_counter()
+    rendered_key = _rendered_key(key)
+    entry = local_cache.get(rendered_key) if local else None
+    if entry is not None:
+        _record(key, 'local_hit', started)
+        return entry
+    stored = cache.get(rendered_key)
+    if not isinstance(stored, dict) or 'body' not in stored:
+        _record(key, 'miss', started)
+        return None
+    # The JSON cache serializer cannot carry bytes, so there the body travels
+    # as UTF-8 text; re-encoding it is a single pass over a rendered string.
+    body = stored['body']
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    entry = RenderedEntry(body, stored['content_type'], len(body))
+    if local:
+        local_cache.set(rendered_key, entry, entry.length)
+    _record(key, 'hit', started)
+    return entry
+
+
+def set_rendered(key, body, content_type, timeout, local=True):
+    started = time.perf_counter()
+    entry = RenderedEntry(body, content_type, len(body))
+    cache.set(_rendered_key(key), {
+        'body': body if BINARY_CACHE_VALUES else body.decode('utf-8'),
+        'content_type': content_type,
+        'length': entry.length,
+    }, timeout=timeout)
+    if local:
+        local_cache.set(_rendered_key(key), entry, entry.length)
+    _record(key, 'set', started, entry.length)
+    return entry
+
+
+def stale_key(key):
+    """Map a versioned key to the version-independent key of its last good copy."""
+    namespace, _, base = key.split(':', 2)
+    return f"{namespace}:stale:{base}"
+
+
+def acquire_lock(key, timeout):
+    # django-redis returns None instead of False when Redis is unreachable; treat
+    # that as acquired so an outage degrades to uncached rebuilds, not waiting.
+    return cache.add(f"{key}:lock", 1, timeout=timeout) is not False
+
+
+def release_lock(key):
+    cache.delete(f"{key}:lock")
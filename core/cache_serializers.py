@@ -0,0 +1,104 @@
+import json
+import uuid
+import zlib
+import datetime
+from decimal import Decimal
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis.serializers.base import BaseSerializer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Every value written by CompactSerializer starts with a two-byte header so
+# it can be told apart from values written by the JSON serializer.
+HEADER_PACKED = b'\x00m'
+HEADER_COMPRESSED = b'\x00z'
+
+EXT_DECIMAL = 1
+EXT_DATETIME = 2
+EXT_DATE = 3
+EXT_TIME = 4
+EXT_UUID = 5
+
+
+def _encode_ext(obj):
+    # datetime must be checked before date, which it subclasses.
+    if isinstance(obj, Decimal):
+        return msgpack.ExtType(EXT_DECIMAL, str(obj).encode())
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+    if isinstance(obj, datetime.date):
+        return msgpack.ExtType(EXT_DATE, obj.isoformat().encode())
+    if isinstance(obj, datetime.time):
+        return msgpack.ExtType(EXT_TIME, obj.isoformat().encode())
+    if isinstance(obj, uuid.UUID):
+        return msgpack.ExtType(EXT_UUID, obj.bytes)
+    raise TypeError(f"Cannot serialize {type(obj).__name__} for the cache")
+
+
+def _decode_ext(code, data):
+    if code == EXT_DECIMAL:
+        return Decimal(data.decode())
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    if code == EXT_DATE:
+        return datetime.date.fromisoformat(data.decode())
+    if code == EXT_TIME:
+        return datetime.time.fromisoformat(data.decode())
+    if code == EXT_UUID:
+        return uuid.UUID(bytes=data)
+    return msgpack.ExtType(code, data)
+
+
+class CompactSerializer(BaseSerializer):
+    """MessagePack encoding with zlib compression for large values.
+
+    Decimal, datetime, date, time and UUID values round-trip with their type.
+    Values without the header were written by the JSON serializer before this
+    one was enabled and are still decoded, so switching ``CACHE_SERIALIZER``
+    to ``msgpack`` needs no cache flush. Values are never unpickled: anything
+    else in Redis is read as JSON or fails.
+
+    Options (from the cache ``OPTIONS``): ``COMPRESS_MIN_LENGTH`` (bytes,
+    default 1024) and ``COMPRESS_LEVEL`` (zlib level, default 6).
+    """
+
+    def __init__(self, options):
+        if msgpack is None:
+            raise ImproperlyConfigured("CACHE_SERIALIZER=msgpack requires the 'msgpack' package.")
+        self.compress_min_length = int(options.get('COMPRESS_MIN_LENGTH', 1024))
+        self.compress_level = int(options.get('COMPRESS_LEVEL', 6))
+
+    def dumps(self, value):
+        packed = msgpack.packb(value, default=_encode_ext, use_bin_type=True)
+        if len(packed) >= self.compress_min_length:
+            compressed = zlib.compress(packed, self.compress_level)
+            if len(compressed) < len(packed):
+                return HEADER_COMPRESSED + compressed
+        return HEADER_PACKED + packed
+
+    def loads(self, value):
+        header = value[:2]
+        if header == HEADER_COMPRESSED:
+            return self._unpack(zlib.decompress(value[2:]))
+        if header == HEADER_PACKED:
+            return self._unpack(value[2:])
+        return json.loads(value.decode())
+
+    def _unpack(self, packed):
+        return msgpack.unpackb(packed, ext_hook=_decode_ext, raw=False, strict_map_key=False)
+
+
+class TransitionalSerializer(CompactSerializer):
+    """Writes JSON like the default serializer but reads MessagePack as well.
+
+    Deploy this everywhere before switching to ``msgpack``, and again before
+    switching back, so no worker meets a format it cannot read during a
+    rolling deploy.
+    """
+
+    def dumps(self, value):
+        return json.dumps(value, cls=DjangoJSONEncoder).encode()
@@ -0,0 +1,126 @@
+import json
+import asyncio
+import logging
+from functools import partial
+from redis import asyncio as aioredis
+from django.conf import settings
+from django.db import transaction
+from django.core.serializers.json import DjangoJSONEncoder
+from core.cache import _redis_client
+
+logger = logging.getLogger(__name__)
+
+QUEUE_EVENTS_CHANNEL = getattr(settings, 'QUEUE_EVENTS_CHANNEL', 'hospital:queue-events')
+SUBSCRIBER_BUFFER = 100
+RECONNECT_DELAY = 1.0
+
+PATIENT_REGISTERED = 'patient_registered'
+PATIENT_SEEN = 'patient_seen'
+APPOINTMENT_CANCELLED = 'appointment_cancelled'
+APPOINTMENT_COMPLETED = 'appointment_completed'
+TREATMENT_CREATED = 'treatment_created'
+
+# Put on a subscriber's queue in place of the events it was too slow to take;
+# the stream answers it with a fresh snapshot.
+RESYNC = object()
+
+
+def queue_event(event, data, doctor_id=None):
+    return {'event': event, 'doctor_id': doctor_id, 'data': data}
+
+
+def publish_queue_events(*events):
+    """Broadcast queue-board events once the current transaction commits.
+
+    With Redis every worker receives them through pub/sub; otherwise they
+    only reach subscribers in this process.
+    """
+    events = [event for event in events if event is not None]
+    if events:
+        messages = [json.dumps(event, cls=DjangoJSONEncoder) for event in events]
+        transaction.on_commit(partial(_publish, messages))
+
+
+def _publish(messages):
+    client = _redis_client()
+    if client is None:
+        for message in messages:
+            broker.dispatch_threadsafe(message)
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for message in messages:
+            pipe.publish(QUEUE_EVENTS_CHANNEL, message)
+        pipe.execute()
+    except Exception:
+        # A missed board update must never fail the write that caused it.
+        logger.warning("Could not publish %d queue event(s)", len(messages), exc_info=True)
+
+
+class QueueEventBroker:
+    """Fans queue events out to the SSE streams of this worker.
+
+    One Redis subscription per process feeds an ``asyncio.Queue`` per client,
+    so idle subscribers cost a queue entry rather than a thread or a Redis
+    connection each.
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._listener = None
+        self._loop = None
+
+    def subscribe(self):
+        loop = self._loop = asyncio.get_running_loop()
+        listening = self._listener is not None and not self._listener.done() and self._listener.get_loop() is loop
+        if not listening and _redis_client() is not None:
+            self._listener = loop.create_task(self._listen())
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_BUFFER)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self._subscribers.discard(queue)
+
+    def dispatch(self, message):
+        event = json.loads(message)
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self._resync(queue)
+
+    def _resync(self, queue):
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RESYNC)
+
+    def dispatch_threadsafe(self, message):
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self.dispatch, message)
+
+    async def _listen(self):
+        options = {'ssl_cert_reqs': None} if settings.REDIS_URL.startswith('rediss://') else {}
+        while True:
+            client = aioredis.from_url(settings.REDIS_URL, **options)
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(QUEUE_EVENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.dispatch(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Queue event subscription lost; reconnecting", exc_info=True)
+                # Anything published meanwhile is gone, so every stream resyncs.
+                for queue in list(self._subscribers):
+                    self._resync(queue)
+                await asyncio.sleep(RECONNECT_DELAY)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
+
+
+broker = QueueEventBroker()
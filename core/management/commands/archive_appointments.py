@@ -0,0 +1,96 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from appointments.models import Appointment, ArchivedAppointment, AppointmentSequence
+from core.cache import APPOINTMENTS, TREATMENTS, bump_namespaces_on_commit, patient_namespace
+from treatments.models import Treatment, ArchivedTreatment
+
+CLOSED_STATUSES = ('completed', 'cancelled')
+APPOINTMENT_COLUMNS = [field.attname for field in Appointment._meta.concrete_fields]
+TREATMENT_COLUMNS = [field.attname for field in Treatment._meta.concrete_fields]
+
+
+def archivable_cases(cutoff):
+    """Initial appointments whose whole case closed before ``cutoff``.
+
+    A case is the initial appointment, its follow-ups and its treatments. It
+    qualifies when every appointment in it is closed and older than the
+    cutoff, and no appointment outside it shares its treatments, so the case
+    can move without breaking a foreign key.
+    """
+    open_follow_ups = Appointment.objects.filter(initial_appointment=OuterRef('pk')).filter(
+        ~Q(status__in=CLOSED_STATUSES) | Q(appointment_date__gte=cutoff)
+    )
+    borrowed_treatments = Appointment.objects.filter(initial_appointment=OuterRef('pk')).exclude(
+        treatment__appointment=OuterRef('pk')
+    )
+    lent_treatments = Appointment.objects.filter(treatment__appointment=OuterRef('pk')).exclude(
+        initial_appointment=OuterRef('pk')
+    )
+    return Appointment.objects.filter(
+        appointment_type='initial', status__in=CLOSED_STATUSES, appointment_date__lt=cutoff
+    ).exclude(Exists(open_follow_ups)).exclude(Exists(borrowed_treatments)).exclude(Exists(lent_treatments))
+
+
+class Command(BaseCommand):
+    help = "Move closed appointment cases older than a cutoff into the archive tables."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than-days', type=int, default=settings.APPOINTMENT_ARCHIVE_AFTER_DAYS,
+            help="Archive cases whose last appointment is older than this (default: APPOINTMENT_ARCHIVE_AFTER_DAYS).",
+        )
+        parser.add_argument('--batch-size', type=int, default=200, help="Cases moved per transaction.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the cases that would move.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['older_than_days'])
+        if options['dry_run']:
+            self.stdout.write(f"{archivable_cases(cutoff).count()} case(s) closed before {cutoff:%Y-%m-%d} can be archived")
+            return
+
+        cases = appointments = treatments = 0
+        while True:
+            with transaction.atomic():
+                # Locked rows belong to a request that may reopen them; they
+                # are left for the next run.
+                initial_ids = list(
+                    archivable_cases(cutoff).select_for_update(skip_locked=True)
+                    .order_by('appointment_date').values_list('pk', flat=True)[:options['batch_size']]
+                )
+                if not initial_ids:
+                    break
+                moved_appointments, moved_treatments = self._archive(initial_ids)
+            cases += len(initial_ids)
+            appointments += moved_appointments
+            treatments += moved_treatments
+            self.stdout.write(f"Archived {cases} case(s) so far")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {cases} case(s): {appointments} appointment(s), {treatments} treatment(s)"
+        ))
+
+    def _archive(self, initial_ids):
+        in_cases = Q(pk__in=initial_ids) | Q(initial_appointment_id__in=initial_ids)
+        appointment_rows = list(Appointment.objects.filter(in_cases).values(*APPOINTMENT_COLUMNS))
+        treatment_rows = list(Treatment.objects.filter(appointment_id__in=initial_ids).values(*TREATMENT_COLUMNS))
+
+        archived_at = timezone.now()
+        ArchivedTreatment.objects.bulk_create(
+            ArchivedTreatment(archived_at=archived_at, **row) for row in treatment_rows
+        )
+        ArchivedAppointment.objects.bulk_create(
+            ArchivedAppointment(archived_at=archived_at, **row) for row in appointment_rows
+        )
+        # Follow-ups protect their initial appointment and treatment, so they go first.
+        Appointment.objects.filter(initial_appointment_id__in=initial_ids).delete()
+        Treatment.objects.filter(appointment_id__in=initial_ids).delete()
+        Appointment.objects.filter(pk__in=initial_ids).delete()
+        AppointmentSequence.objects.filter(name__in=[f"case_followup_seq:{pk}" for pk in initial_ids]).delete()
+
+        patient_ids = {row['patient_id'] for row in appointment_rows}
+        bump_namespaces_on_commit(APPOINTMENTS, TREATMENTS, *(patient_namespace(pk) for pk in patient_ids))
+        return len(appointment_rows), len(treatment_rows)
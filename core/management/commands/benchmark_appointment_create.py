@@ -0,0 +1,74 @@
+import statistics
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from accounts.models import User
+from appointments.models import Appointment, DEFAULT_SLOT_MINUTES
+from appointments.views import AppointmentViewSet
+from patients.models import Patient
+from treatments.models import Treatment
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = "Measure queries and latency per appointment created through the API."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=50, help="Appointments created per type.")
+
+    def handle(self, *args, **options):
+        # Everything runs in one transaction that is rolled back, so the
+        # benchmark leaves no rows behind and burns no display numbers.
+        try:
+            with transaction.atomic():
+                self._run(options['repeat'])
+                raise Rollback
+        except Rollback:
+            pass
+
+    def _run(self, repeat):
+        doctor = User.objects.create_user(username='benchmark_doctor', role='doctor')
+        patient = Patient.objects.create(
+            first_name='Benchmark', last_name='Patient', gender='F', contact_number='0900000000', assigned_doctor=doctor,
+        )
+        initial = Appointment.objects.create(patient=patient, doctor=doctor)
+        treatment = Treatment.objects.create(patient=patient, doctor=doctor, appointment=initial, notes='Benchmark.')
+        view = AppointmentViewSet.as_view({'post': 'create'})
+        factory = APIRequestFactory()
+        payloads = {
+            'initial': {'patient_id': patient.id, 'doctor_id': doctor.id},
+            'follow_up': {
+                'patient_id': patient.id, 'doctor_id': doctor.id, 'appointment_type': 'follow_up',
+                'initial_appointment_id': initial.id, 'treatment': treatment.id,
+            },
+        }
+
+        self.stdout.write(f"{repeat} creates per type\n")
+        self.stdout.write(f"{'type':<12}{'queries':>9}{'mean ms':>10}{'p95 ms':>9}")
+        for label, payload in payloads.items():
+            queries, timings = [], []
+            # Consecutive slots, so follow-ups never clash with each other.
+            start = timezone.now() + timedelta(days=1)
+            for i in range(repeat):
+                when = start + timedelta(minutes=DEFAULT_SLOT_MINUTES * i)
+                request = factory.post('/appointments/', {**payload, 'appointment_date': when}, format='json')
+                force_authenticate(request, user=doctor)
+                with CaptureQueriesContext(connection) as captured:
+                    started = time.perf_counter()
+                    response = view(request)
+                    timings.append((time.perf_counter() - started) * 1000)
+                if response.status_code != 201:
+                    self.stderr.write(f"{label}: create failed with {response.status_code}: {response.data}")
+                    return
+                queries.append(len(captured))
+            p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+            self.stdout.write(
+                f"{label:<12}{statistics.mean(queries):>9.1f}{statistics.mean(timings):>10.2f}{p95:>9.2f}"
+            )
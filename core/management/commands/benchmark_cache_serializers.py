@@ -0,0 +1,122 @@
+import sys
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from django_redis.serializers.json import JSONSerializer
+from core.cache_serializers import CompactSerializer
+
+FIRST_NAMES = ['Abebe', 'Almaz', 'Bekele', 'Chaltu', 'Dawit', 'Eleni', 'Fikru', 'Hanna', 'Kebede', 'Meron']
+LAST_NAMES = ['Tesfaye', 'Girma', 'Haile', 'Mekonnen', 'Alemu', 'Tadesse', 'Wolde', 'Bekele']
+
+
+def _doctor(i):
+    return {'id': i, 'username': f'dr_{i}', 'email': f'dr_{i}@hospital.et', 'first_name': 'Dr', 'last_name': LAST_NAMES[i % 8]}
+
+
+def _patient_rows(count, now):
+    rows = []
+    for i in range(1, count + 1):
+        created = now - timedelta(minutes=7 * i)
+        rows.append({
+            'id': i,
+            'first_name': random.choice(FIRST_NAMES),
+            'last_name': random.choice(LAST_NAMES),
+            'date_of_birth': f'19{random.randint(50, 99)}-0{random.randint(1, 9)}-1{random.randint(0, 9)}',
+            'gender': random.choice('MF'),
+            'contact_number': f'09{random.randint(10000000, 99999999)}',
+            'address': f'Kebele {random.randint(1, 30)}, Addis Ababa',
+            'assigned_doctor': _doctor(i % 12 + 1),
+            'queue_number': i % 80 + 1,
+            'is_seen': bool(i % 3),
+            'created_at': created.isoformat(),
+            'updated_at': created.isoformat(),
+        })
+    return rows
+
+
+def _appointment_payload(count, now):
+    payload = {'initial': [], 'follow_up': []}
+    for i in range(1, count + 1):
+        follow_up = i % 4 == 0
+        created = now - timedelta(minutes=5 * i)
+        payload['follow_up' if follow_up else 'initial'].append({
+            'id': i,
+            'display_id': f"{'F' if follow_up else 'I'}-{i}",
+            'patient': {
+                'id': i, 'first_name': random.choice(FIRST_NAMES), 'last_name': random.choice(LAST_NAMES),
+                'gender': random.choice('MF'), 'date_of_birth': None,
+            },
+            'doctor': {'id': i % 12 + 1, 'username': f'dr_{i % 12 + 1}', 'email': f'dr_{i % 12 + 1}@hospital.et'},
+            'appointment_date': created.isoformat(),
+            'appointment_type': 'follow_up' if follow_up else 'initial',
+            'initial_appointment': i - 1 if follow_up else None,
+            'treatment': i // 2 if follow_up else None,
+            'notes': 'Initial consultation upon registration.',
+            'status': random.choice(['pending', 'completed', 'cancelled']),
+            'created_at': created.isoformat(),
+            'updated_at': created.isoformat(),
+        })
+    return payload
+
+
+def _native_payment_rows(count, now):
+    # Unserialized model-style values, to exercise Decimal/datetime fidelity.
+    return [
+        {
+            'id': i,
+            'patient': i,
+            'amount': Decimal(random.randint(100, 2000)) / 4,
+            'payment_method': random.choice(['cash', 'chapa']),
+            'status': 'paid',
+            'created_at': now - timedelta(minutes=3 * i),
+        }
+        for i in range(1, count + 1)
+    ]
+
+
+class Command(BaseCommand):
+    help = "Compare payload size and encode/decode time of the cache serializers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=500, help="Rows per synthetic payload.")
+        parser.add_argument('--repeat', type=int, default=50, help="Timed iterations per measurement.")
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        now = timezone.now()
+        rows, repeat = options['rows'], options['repeat']
+        payloads = {
+            'patients list': _patient_rows(rows, now),
+            'appointments grouped': _appointment_payload(rows, now),
+            'payments (native types)': _native_payment_rows(rows, now),
+        }
+        serializers = {
+            'json': JSONSerializer({}),
+            'msgpack': CompactSerializer({'COMPRESS_MIN_LENGTH': sys.maxsize}),
+            'msgpack+zlib': CompactSerializer({}),
+        }
+
+        self.stdout.write(f"{rows} rows per payload, {repeat} iterations\n")
+        self.stdout.write(f"{'payload':<26}{'serializer':<14}{'bytes':>10}{'ratio':>8}{'dumps ms':>11}{'loads ms':>11}  round-trip")
+        for name, payload in payloads.items():
+            baseline = None
+            for label, serializer in serializers.items():
+                encoded = serializer.dumps(payload)
+                baseline = baseline or len(encoded)
+                dumps_ms = self._time(lambda: serializer.dumps(payload), repeat)
+                loads_ms = self._time(lambda: serializer.loads(encoded), repeat)
+                fidelity = 'exact' if serializer.loads(encoded) == payload else 'lossy'
+                self.stdout.write(
+                    f"{name:<26}{label:<14}{len(encoded):>10}{len(encoded) / baseline:>8.2f}"
+                    f"{dumps_ms:>11.3f}{loads_ms:>11.3f}  {fidelity}"
+                )
+
+    def _time(self, func, repeat):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        return (time.perf_counter() - started) * 1000 / repeat
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from appointments.models import DoctorLoad
+
+
+class Command(BaseCommand):
+    help = "Rebuild today's doctor load counters from the tables and drop earlier days."
+
+    def handle(self, *args, **options):
+        today = timezone.now().date()
+        DoctorLoad.recount(today)
+        pruned, _ = DoctorLoad.objects.filter(day__lt=today).delete()
+        self.stdout.write(self.style.SUCCESS(
+            f"Recounted {DoctorLoad.objects.filter(day=today).count()} doctor loads for {today}; "
+            f"pruned {pruned} older rows."
+        ))
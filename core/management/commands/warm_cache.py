@@ -0,0 +1,120 @@
+from collections import defaultdict
+from urllib.parse import urlsplit
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+from django.test import RequestFactory
+from django.utils import timezone
+from rest_framework.request import Request
+from accounts.models import User
+from accounts.views import UserAdminViewSet
+from appointments.views import AppointmentViewSet
+from treatments.views import TreatmentViewSet
+from patients.views import PatientViewSet
+from payments.views import PaymentViewSet
+from core.pagination import PrefetchedRows
+
+
+class Command(BaseCommand):
+    help = "Precompute today's payloads and first list pages for staff and every active doctor."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--base-url',
+            default=settings.PUBLIC_BASE_URL,
+            help="Public origin used for pagination links in the cached pages.",
+        )
+
+    def handle(self, *args, **options):
+        self.base_url = urlsplit(options['base_url'])
+        self.primed = 0
+        today = timezone.now().date()
+        doctors = list(User.objects.filter(role='doctor', is_active=True))
+        # Unsaved stand-in: any non-doctor role sees the unscoped querysets.
+        staff = User(role='admin')
+
+        self._warm_appointments(today, doctors, staff)
+        self._warm_treatments(today, doctors, staff)
+        for viewset_class, path in (
+            (PatientViewSet, '/patients/'),
+            (PaymentViewSet, '/payments/'),
+            (UserAdminViewSet, '/accounts/users/'),
+        ):
+            view = self._view(viewset_class, 'list', staff, path)
+            self._prime_list(view, view.filter_queryset(view.get_queryset()))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Primed {self.primed} cache entries for {len(doctors)} doctors."
+        ))
+
+    def _warm_appointments(self, today, doctors, staff):
+        view = self._view(AppointmentViewSet, 'today', staff, '/appointments/today/')
+        todays = list(view.get_today_queryset(today))
+        by_doctor = _group_by_doctor(todays)
+        self._prime(view, view.get_today_cache_key(view.request, today), view.group_appointment_rows(todays))
+        for doctor in doctors:
+            view = self._view(AppointmentViewSet, 'today', doctor, '/appointments/today/')
+            rows = by_doctor.get(doctor.id, [])
+            self._prime(view, view.get_today_cache_key(view.request, today), view.group_appointment_rows(rows))
+
+        view = self._view(AppointmentViewSet, 'list', staff, '/appointments/')
+        self._prime_list(view, view.get_queryset())
+        first_pages = self._first_pages(view, view.get_queryset(), 'appointment_date')
+        for doctor in doctors:
+            view = self._view(AppointmentViewSet, 'list', doctor, '/appointments/')
+            self._prime_list(view, PrefetchedRows(first_pages.get(doctor.id, [])))
+
+    def _warm_treatments(self, today, doctors, staff):
+        view = self._view(TreatmentViewSet, 'today', staff, '/treatments/today/')
+        todays = list(view.get_queryset().filter(created_at__date=today).order_by('created_at'))
+        by_doctor = _group_by_doctor(todays)
+        self._prime(view, view.get_today_cache_key(view.request, today), view.serialize_rows(todays))
+
+        view = self._view(TreatmentViewSet, 'list', staff, '/treatments/')
+        self._prime_list(view, view.filter_queryset(view.get_queryset()))
+
+        # A doctor's treatment views only ever show today's rows, so the rows
+        # loaded above are also every doctor's complete first list page.
+        for doctor in doctors:
+            rows = by_doctor.get(doctor.id, [])
+            view = self._view(TreatmentViewSet, 'today', doctor, '/treatments/today/')
+            self._prime(view, view.get_today_cache_key(view.request, today), view.serialize_rows(rows))
+            view = self._view(TreatmentViewSet, 'list', doctor, '/treatments/')
+            self._prime_list(view, PrefetchedRows(reversed(rows)))
+
+    def _first_pages(self, view, queryset, order_field):
+        """Load the first page (plus one look-ahead row) for every doctor in one query."""
+        size = view.paginator.get_page_size(view.request) + 1
+        ranked = queryset.annotate(
+            row_number=Window(
+                RowNumber(),
+                partition_by=[F('doctor_id')],
+                order_by=F(order_field).desc(),
+            )
+        ).filter(row_number__lte=size).order_by(f"-{order_field}")
+        return _group_by_doctor(ranked)
+
+    def _prime_list(self, view, rows):
+        self._prime(view, view.get_list_cache_key(view.request), view.get_list_payload(rows))
+
+    def _prime(self, view, key, payload):
+        view.prime_cache(view.make_cache_key(key), payload)
+        self.primed += 1
+
+    def _view(self, viewset_class, action, user, path):
+        django_request = RequestFactory().get(
+            path,
+            secure=self.base_url.scheme == 'https',
+            HTTP_HOST=self.base_url.netloc,
+        )
+        request = Request(django_request)
+        request.user = user
+        return viewset_class(request=request, args=(), kwargs={}, format_kwarg=None, action=action)
+
+
+def _group_by_doctor(rows):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[row.doctor_id].append(row)
+    return grouped
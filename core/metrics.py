@@ -0,0 +1,120 @@
+import os
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {_format_bound(bound): total for bound, total in self.cumulative()},
+        }
+
+
+class CacheMetrics:
+    """In-process cache counters and histograms, labelled by prefix and operation.
+
+    Each worker aggregates its own numbers; ``pid`` is exported so scraped
+    series from different workers stay distinguishable.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.latencies = {}
+            self.payload_sizes = {}
+
+    def record(self, prefix, operation, seconds=None, size=None):
+        with self._lock:
+            self.counters[(prefix, operation)] += 1
+            if seconds is not None:
+                histogram = self.latencies.get((prefix, operation))
+                if histogram is None:
+                    histogram = self.latencies[(prefix, operation)] = Histogram(LATENCY_BUCKETS)
+                histogram.observe(seconds)
+            if size is not None:
+                histogram = self.payload_sizes.get(prefix)
+                if histogram is None:
+                    histogram = self.payload_sizes[prefix] = Histogram(SIZE_BUCKETS)
+                histogram.observe(size)
+
+    def snapshot(self):
+        with self._lock:
+            prefixes = defaultdict(lambda: {'operations': {}, 'latency_seconds': {}, 'payload_bytes': None})
+            for (prefix, operation), count in self.counters.items():
+                prefixes[prefix]['operations'][operation] = count
+            for (prefix, operation), histogram in self.latencies.items():
+                prefixes[prefix]['latency_seconds'][operation] = histogram.as_dict()
+            for prefix, histogram in self.payload_sizes.items():
+                prefixes[prefix]['payload_bytes'] = histogram.as_dict()
+            return {'pid': os.getpid(), 'prefixes': dict(prefixes)}
+
+    def render_text(self):
+        """Render all series in the Prometheus text exposition format."""
+        pid = os.getpid()
+        lines = [
+            '# HELP cache_operations_total Cache operations by prefix and operation.',
+            '# TYPE cache_operations_total counter',
+        ]
+        with self._lock:
+            for (prefix, operation), count in sorted(self.counters.items()):
+                lines.append(f'cache_operations_total{{pid="{pid}",prefix="{prefix}",operation="{operation}"}} {count}')
+
+            lines += [
+                '# HELP cache_operation_seconds Cache operation latency.',
+                '# TYPE cache_operation_seconds histogram',
+            ]
+            for (prefix, operation), histogram in sorted(self.latencies.items()):
+                labels = f'pid="{pid}",prefix="{prefix}",operation="{operation}"'
+                lines += _histogram_lines('cache_operation_seconds', labels, histogram)
+
+            lines += [
+                '# HELP cache_payload_bytes Size of payloads written to the cache.',
+                '# TYPE cache_payload_bytes histogram',
+            ]
+            for prefix, histogram in sorted(self.payload_sizes.items()):
+                lines += _histogram_lines('cache_payload_bytes', f'pid="{pid}",prefix="{prefix}"', histogram)
+        return '\n'.join(lines) + '\n'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _histogram_lines(name, labels, histogram):
+    lines = [
+        f'{name}_bucket{{{labels},le="{_format_bound(bound)}"}} {total}'
+        for bound, total in histogram.cumulative()
+    ]
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+    return lines
+
+
+cache_metrics = CacheMetrics()
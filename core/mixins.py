@@ -1,60 +1,215 @@
+import time
+import hashlib
 import logging
-from django.core.cache import cache
+from urllib.parse import urlencode
 from django.conf import settings
+from django.http import HttpResponse
+from django.http.response import HttpResponseBase
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.exceptions import APIException
+from core.cache import (
+    RenderedEntry, versioned_key, patient_namespace, bump_namespaces_on_commit, get_cached, set_cached,
+    get_rendered, set_rendered, stale_key, acquire_lock, release_lock, metrics_label,
+)
+from core.metrics import cache_metrics
 
 logger = logging.getLogger(__name__)
 CACHE_TTL = getattr(settings, 'CACHE_TTL', 300)
+CACHE_RENDERED_RESPONSES = getattr(settings, 'CACHE_RENDERED_RESPONSES', True)
+JSON_CONTENT_TYPE = 'application/json'
+LOCK_POLL_INTERVAL = 0.05
+
+
+class CacheRebuildInProgress(APIException):
+    status_code = 503
+    default_detail = "Data is being refreshed, please retry shortly."
+    default_code = "cache_rebuild_in_progress"
+
 
 class CacheResponseMixin:
     cache_key_prefix = None
+    cache_namespace = None
+    cache_rendered_response = CACHE_RENDERED_RESPONSES
+    # Stampede protection: lock lifetime and how long losers wait (seconds),
+    # how old a copy may be and still be served while another request
+    # rebuilds it, and what to do once the wait runs out ('rebuild' or
+    # 'unavailable').
+    cache_lock_timeout = 10
+    cache_lock_wait = 2.0
+    cache_stale_ttl = 60
+    cache_lock_fallback = 'rebuild'
 
     def get_cache_key_prefix(self):
         if self.cache_key_prefix is None:
             return self.__class__.__name__.lower().replace('viewset', '')
         return self.cache_key_prefix
 
+    def get_cache_namespace(self):
+        if self.cache_namespace is None:
+            return f"{self.get_cache_key_prefix()}s"
+        return self.cache_namespace
+
+    def make_cache_key(self, key, namespace=None):
+        return versioned_key(namespace or self.get_cache_namespace(), key)
+
+    def cached_response(self, cache_key, build_payload, label):
+        """Serve ``cache_key`` from cache, calling ``build_payload`` on a miss.
+
+        In rendered mode the final JSON body is cached and returned byte for
+        byte, skipping the decode/re-render round trip on every hit. Misses are
+        single-flight: one request rebuilds under a short lock while the others
+        serve the last good copy (within ``cache_stale_ttl``) or wait up to
+        ``cache_lock_wait`` seconds before applying ``cache_lock_fallback``.
+        """
+        entry = self._load_cache_entry(cache_key)
+        if entry is not None:
+            logger.debug("%s cache hit", label)
+            return self._cache_entry_response(entry)
+
+        if not acquire_lock(cache_key, self.cache_lock_timeout):
+            entry = self._wait_for_rebuild(cache_key, label)
+            if entry is not None:
+                return self._cache_entry_response(entry)
+            cache_metrics.record(metrics_label(cache_key.partition(':')[0]), 'lock_wait_expired')
+            if self.cache_lock_fallback == 'unavailable':
+                raise CacheRebuildInProgress()
+            logger.debug("%s lock wait expired; rebuilding without lock", label)
+            return self._rebuild_cache_entry(cache_key, build_payload, label)
+
+        try:
+            return self._rebuild_cache_entry(cache_key, build_payload, label)
+        finally:
+            release_lock(cache_key)
+
+    def _rebuild_cache_entry(self, cache_key, build_payload, label):
+        started = time.perf_counter()
+        payload = build_payload()
+        if isinstance(payload, HttpResponseBase):
+            return payload
+        cache_metrics.record(metrics_label(cache_key.partition(':')[0]), 'rebuild', time.perf_counter() - started)
+        logger.debug("%s cache miss; rebuilt payload", label)
+        entry = self._store_cache_entry(cache_key, payload)
+        return self._cache_entry_response(entry)
+
+    def _wait_for_rebuild(self, cache_key, label):
+        if self.cache_stale_ttl > 0:
+            entry = self._load_cache_entry(stale_key(cache_key), local=False)
+            if entry is not None:
+                logger.debug("%s rebuild in progress; serving stale copy", label)
+                return entry
+
+        deadline = time.monotonic() + self.cache_lock_wait
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            entry = self._load_cache_entry(cache_key)
+            if entry is not None:
+                logger.debug("%s served after waiting for rebuild", label)
+                return entry
+        return None
+
+    def prime_cache(self, cache_key, payload):
+        """Store ``payload`` under ``cache_key`` exactly as a cache miss would."""
+        return self._store_cache_entry(cache_key, payload)
+
+    def _load_cache_entry(self, key, local=True):
+        if self.cache_rendered_response:
+            return get_rendered(key, local=local)
+        return get_cached(key, local=local)
+
+    def _store_cache_entry(self, cache_key, payload):
+        # The last good copy expires cache_stale_ttl seconds after it was
+        # built, so a lock loser is never served data older than that.
+        stale_timeout = self.cache_stale_ttl
+        if self.cache_rendered_response:
+            body = JSONRenderer().render(payload)
+            entry = set_rendered(cache_key, body, JSON_CONTENT_TYPE, CACHE_TTL)
+            if self.cache_stale_ttl > 0:
+                set_rendered(stale_key(cache_key), body, JSON_CONTENT_TYPE, stale_timeout, local=False)
+            return entry
+
+        entry = set_cached(cache_key, payload, CACHE_TTL)
+        if self.cache_stale_ttl > 0:
+            set_cached(stale_key(cache_key), entry, stale_timeout, local=False)
+        return entry
+
+    def _cache_entry_response(self, entry):
+        if isinstance(entry, RenderedEntry):
+            response = HttpResponse(entry.body, content_type=entry.content_type, status=status.HTTP_200_OK)
+            response['Content-Length'] = entry.length
+            return response
+        return Response(entry, status=status.HTTP_200_OK)
+
+    def get_cache_scope(self, request):
+        """Identify the slice of ``get_queryset()`` this request can see.
+
+        Viewsets whose querysets depend on the user (role, id, date) must
+        override this so differently scoped callers never share an entry.
+        """
+        return ''
+
+    def get_query_cache_suffix(self, request):
+        # Canonical form of the query string: parameters and repeated values are
+        # sorted and the page size is clamped by the paginator, so equivalent
+        # URLs share one entry and arbitrary sizes cannot fan out keys.
+        params = {name: sorted(request.query_params.getlist(name)) for name in request.query_params}
+        paginator = self.paginator
+        if paginator is not None and getattr(paginator, 'page_size_query_param', None):
+            params[paginator.page_size_query_param] = [str(paginator.get_page_size(request))]
+        if not params:
+            return ''
+        canonical = urlencode(sorted(params.items()), doseq=True)
+        return f"_q_{hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:20]}"
+
+    def get_list_cache_key(self, request):
+        prefix = self.get_cache_key_prefix()
+        return f"all_{prefix}s{self.get_cache_scope(request)}{self.get_query_cache_suffix(request)}"
+
+    def get_list_payload(self, queryset):
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.serialize_rows(page)).data
+        return self.serialize_rows(queryset)
+
+    def serialize_rows(self, rows):
+        return self.get_serializer(rows, many=True).data
+
     def list(self, request, *args, **kwargs):
         prefix = self.get_cache_key_prefix()
-        cache_key = f"all_{prefix}s"
-        data = cache.get(cache_key)
-
-        if not data:
-            queryset = self.filter_queryset(self.get_queryset())
-            page = self.paginate_queryset(queryset)
-            if page is not None:
-                serializer = self.get_serializer(page, many=True)
-                return self.get_paginated_response(serializer.data)
-
-            serializer = self.get_serializer(queryset, many=True)
-            data = serializer.data
-            cache.set(cache_key, data, timeout=CACHE_TTL)
-            logger.debug("%s.list cache miss; cached %d records", prefix, len(data))
-        else:
-            logger.debug("%s.list cache hit", prefix)
+        cache_key = self.make_cache_key(self.get_list_cache_key(request))
+
+        def build_payload():
+            return self.get_list_payload(self.filter_queryset(self.get_queryset()))
 
-        return Response(data, status=status.HTTP_200_OK)
+        return self.cached_response(cache_key, build_payload, f"{prefix}.list")
 
     def retrieve(self, request, pk=None, *args, **kwargs):
         prefix = self.get_cache_key_prefix()
-        cache_key = f"{prefix}_{pk}"
-        data = cache.get(cache_key)
-
-        if not data:
-            instance = self.get_object()
-            serializer = self.get_serializer(instance)
-            data = serializer.data
-            cache.set(cache_key, data, timeout=CACHE_TTL)
-            logger.debug("%s.retrieve cache miss for id=%s", prefix, pk)
-        else:
-            logger.debug("%s.retrieve cache hit for id=%s", prefix, pk)
+        cache_key = self.make_cache_key(f"{prefix}_{pk}{self.get_cache_scope(request)}")
+
+        def build_payload():
+            return self.get_serializer(self.get_object()).data
 
-        return Response(data, status=status.HTTP_200_OK)
+        return self.cached_response(cache_key, build_payload, f"{prefix}.retrieve id={pk}")
 
 class CacheInvalidationMixin:
-    def get_cache_keys_to_invalidate(self, instance):
-        return []
+    cache_namespaces_to_invalidate = None
+    # Attribute of the written instance holding its patient's id; when set,
+    # writes also invalidate that patient's own namespace (see patient_namespace).
+    cache_patient_id_attr = None
+
+    def get_cache_namespaces_to_invalidate(self, instance):
+        if self.cache_namespaces_to_invalidate is not None:
+            namespaces = list(self.cache_namespaces_to_invalidate)
+        elif hasattr(self, 'get_cache_namespace'):
+            namespaces = [self.get_cache_namespace()]
+        else:
+            namespaces = []
+        patient_id = getattr(instance, self.cache_patient_id_attr, None) if self.cache_patient_id_attr else None
+        if patient_id is not None:
+            namespaces.append(patient_namespace(patient_id))
+        return namespaces
 
     def perform_create(self, serializer):
         instance = serializer.save()
@@ -65,12 +220,24 @@ class CacheInvalidationMixin:
         self._invalidate_cache(instance)
 
     def perform_destroy(self, instance):
-        self._invalidate_cache(instance)
         instance.delete()
+        self._invalidate_cache(instance)
 
     def _invalidate_cache(self, instance):
-        keys = self.get_cache_keys_to_invalidate(instance)
-        if keys:
-            for key in keys:
-                cache.delete(key)
-            logger.debug("Invalidated cache keys: %s", keys)
+        # Namespaces are collected for the whole request and flushed once by
+        # finalize_response, after the surrounding transaction commits.
+        namespaces = self.get_cache_namespaces_to_invalidate(instance)
+        if namespaces:
+            pending = getattr(self, '_pending_cache_namespaces', set())
+            self._pending_cache_namespaces = pending | set(namespaces)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        self._flush_cache_invalidations()
+        return response
+
+    def _flush_cache_invalidations(self):
+        namespaces = getattr(self, '_pending_cache_namespaces', None)
+        if namespaces:
+            self._pending_cache_namespaces = set()
+            bump_namespaces_on_commit(*namespaces)
@@ -0,0 +1,29 @@
+from rest_framework.pagination import CursorPagination
+
+
+class PrefetchedRows(list):
+    """Rows already loaded in the paginator's ordering, standing in for a queryset.
+
+    Lets bulk jobs fetch the first page for many scopes in one grouped query and
+    still have ``CursorPagination`` build the page and its links. Only valid
+    without a cursor, and the rows must include one extra row past the page
+    when there is a next page.
+    """
+
+    def order_by(self, *fields):
+        return self
+
+
+class CreatedAtCursorPagination(CursorPagination):
+    ordering = '-created_at'
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
+
+
+class AppointmentDateCursorPagination(CreatedAtCursorPagination):
+    ordering = '-appointment_date'
+
+
+class IdCursorPagination(CreatedAtCursorPagination):
+    ordering = '-id'
@@ -41,6 +41,11 @@ CSRF_TRUSTED_ORIGINS = [
 
 PAYMENT_RETURN_URL = os.getenv('PAYMENT_RETURN_URL')
 DEFAULT_PAYMENT_EMAIL = os.getenv('DEFAULT_PAYMENT_EMAIL')
+# Public origin used when links are rendered outside a request (cache warming)
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', 'http://localhost:8000')
+# Closed appointment cases older than this are moved to the archive tables
+# by the archive_appointments command.
+APPOINTMENT_ARCHIVE_AFTER_DAYS = int(os.getenv('APPOINTMENT_ARCHIVE_AFTER_DAYS', 365))
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -54,6 +59,7 @@ INSTALLED_APPS = [
     'rest_framework',
     'drf_spectacular',
 
+    'core',
     'accounts',
     'patients',
     'appointments',
@@ -99,12 +105,16 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'core.wsgi.application'
+# Only /queue/stream/ is served under ASGI, by its own process (see Procfile).
+ASGI_APPLICATION = 'core.asgi.application'
 
 if dj_database_url:
     DATABASES = {
         'default': dj_database_url.config(
             default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
-            conn_max_age=600,
+            # The ASGI entry point lowers this to 0: persistent connections
+            # leak under its per-request threads.
+            conn_max_age=int(os.getenv('DB_CONN_MAX_AGE', 600)),
             conn_health_checks=True,
         )
     }
@@ -151,6 +161,7 @@ REST_FRAMEWORK = {
         'rest_framework_simplejwt.authentication.JWTAuthentication',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.CreatedAtCursorPagination',
 }
 
 SIMPLE_JWT = {
@@ -174,11 +185,14 @@ if not REDIS_URL:
 
 CACHE_KEY_PREFIX = os.getenv('CACHE_KEY_PREFIX', 'hospital_mgmt')
 CACHE_SERIALIZER = os.getenv('CACHE_SERIALIZER', 'json').lower()
-_serializer_path = (
-    'django_redis.serializers.pickle.PickleSerializer' 
-    if CACHE_SERIALIZER == 'pickle' 
-    else 'django_redis.serializers.json.JSONSerializer'
-)
+_serializer_paths = {
+    'pickle': 'django_redis.serializers.pickle.PickleSerializer',
+    # MessagePack + zlib above COMPRESS_MIN_LENGTH; still reads values written as JSON
+    'msgpack': 'core.cache_serializers.CompactSerializer',
+    # Writes JSON, reads JSON and MessagePack; the step between the two
+    'json-compat': 'core.cache_serializers.TransitionalSerializer',
+}
+_serializer_path = _serializer_paths.get(CACHE_SERIALIZER, 'django_redis.serializers.json.JSONSerializer')
 
 CACHES = {
     "default": {
@@ -189,12 +203,26 @@ CACHES = {
             "SERIALIZER": _serializer_path,
             "SSL_CERT_REQS": None,  # Required for some Upstash configurations
             "IGNORE_EXCEPTIONS": True,
+            "COMPRESS_MIN_LENGTH": int(os.getenv('CACHE_COMPRESS_MIN_LENGTH', 1024)),
         },
         "KEY_PREFIX": CACHE_KEY_PREFIX,
     }
 }
 
 CACHE_TTL = int(os.getenv('CACHE_TTL', 60 * 60 * 24))
+CACHE_RENDERED_RESPONSES = os.getenv('CACHE_RENDERED_RESPONSES', 'true').lower() == 'true'
+
+# Per-worker in-process tier in front of Redis (see core.cache.LocalLRUCache)
+LOCAL_CACHE_MAX_BYTES = int(os.getenv('LOCAL_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', 30))
+# Seconds a worker may reuse a namespace version before reading it from Redis
+# again. 0 (the default) reads it on every access, so a write on any worker is
+# seen by the next request everywhere; a positive value trades that for one
+# Redis round trip per cache hit.
+NAMESPACE_VERSION_LOCAL_TTL = int(os.getenv('NAMESPACE_VERSION_LOCAL_TTL', 0))
+
+# Redis pub/sub channel carrying live queue board events (see core.events)
+QUEUE_EVENTS_CHANNEL = os.getenv('QUEUE_EVENTS_CHANNEL', f'{CACHE_KEY_PREFIX}:queue-events')
 
 LOGGING = {
     'version': 1,
@@ -212,6 +240,11 @@ LOGGING = {
             'level': 'INFO',
             'propagate': False,
         },
+        'core': {
+            'handlers': ['console'],
+            'level': os.getenv('CACHE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
         'patients': {
             'handlers': ['console'],
             'level': 'DEBUG',
@@ -0,0 +1,387 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import datetime
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+from accounts.models import User
+from appointments.models import Appointment
+from core.cache import (
+    PATIENT_NAMESPACE_VERSION_TTL, local_cache, local_versions, versioned_key, bump_namespaces,
+    acquire_lock, patient_namespace,
+)
+from core.cache_serializers import (
+    HEADER_COMPRESSED, HEADER_PACKED, CompactSerializer, TransitionalSerializer, msgpack,
+)
+from core.metrics import cache_metrics
+from core.mixins import CacheInvalidationMixin, CacheResponseMixin
+from core.pagination import CreatedAtCursorPagination
+from patients.models import Patient
+from patients.views import PatientViewSet
+from treatments.models import Treatment
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class NamespaceInvalidationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        cls.patient = Patient.objects.create(
+            first_name='Abebe', last_name='Kebede', gender='M', contact_number='0911000000', address='Bole',
+        )
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+
+    def addresses(self):
+        return [row['address'] for row in self.client.get('/patients/').json()['results']]
+
+    def test_bump_only_moves_its_own_namespace(self):
+        patients, payments = versioned_key('patients', 'list'), versioned_key('payments', 'list')
+        bump_namespaces('patients')
+        self.assertNotEqual(versioned_key('patients', 'list'), patients)
+        self.assertEqual(versioned_key('payments', 'list'), payments)
+
+    def test_write_invalidates_cached_lists(self):
+        self.assertEqual(self.addresses(), ['Bole'])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(f'/patients/{self.patient.pk}/', {'address': 'Kirkos'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.addresses(), ['Kirkos'])
+
+
+@skipUnless(msgpack, "msgpack is not installed")
+class CompactSerializerTests(SimpleTestCase):
+    payload = {
+        'amount': Decimal('500.25'),
+        'paid_at': datetime.datetime(2026, 3, 1, 9, 30, 15, 120000, tzinfo=datetime.timezone.utc),
+        'rows': [
+            {'id': 1, 'day': datetime.date(2026, 3, 1), 'at': datetime.time(9, 15), 'ref': uuid.UUID(int=7)},
+            {'id': 2, 'tags': ['initial', None, True], 'nested': {'depth': [1, {'two': 2.5}]}},
+        ],
+    }
+
+    def setUp(self):
+        self.serializer = CompactSerializer({'COMPRESS_MIN_LENGTH': 256})
+
+    def test_round_trip_keeps_types(self):
+        restored = self.serializer.loads(self.serializer.dumps(self.payload))
+        self.assertEqual(restored, self.payload)
+        self.assertIsInstance(restored['amount'], Decimal)
+        self.assertEqual(restored['paid_at'].tzinfo, datetime.timezone.utc)
+
+    def test_large_values_are_compressed(self):
+        large = dict(self.payload, rows=self.payload['rows'] * 50)
+        stored = self.serializer.dumps(large)
+        self.assertTrue(stored.startswith(HEADER_COMPRESSED))
+        self.assertEqual(self.serializer.loads(stored), large)
+        self.assertTrue(self.serializer.dumps({'id': 1}).startswith(HEADER_PACKED))
+
+    def test_values_written_as_json_are_still_read(self):
+        self.assertEqual(self.serializer.loads(b'{"payload": [1, "two"], "length": 12}'),
+                         {'payload': [1, 'two'], 'length': 12})
+
+    def test_pickled_values_are_never_unpickled(self):
+        with self.assertRaises(ValueError):
+            self.serializer.loads(pickle.dumps({'id': 1}))
+
+    def test_transitional_serializer_writes_json_and_reads_both(self):
+        transitional = TransitionalSerializer({})
+        stored = transitional.dumps({'amount': Decimal('500.25'), 'rows': [1, 2]})
+        self.assertEqual(json.loads(stored), {'amount': '500.25', 'rows': [1, 2]})
+        self.assertEqual(transitional.loads(self.serializer.dumps(self.payload)), self.payload)
+
+
+class StaleProbe(CacheResponseMixin):
+    cache_stale_ttl = 60
+    cache_lock_wait = 0
+    cache_rendered_response = False
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CursorPageCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        for number in range(3):
+            Patient.objects.create(
+                first_name='Abebe', last_name='Kebede', gender='M', contact_number=f'091100000{number}',
+            )
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+
+    def cache_suffix(self, **params):
+        request = Request(APIRequestFactory().get('/patients/', params))
+        return PatientViewSet(request=request, format_kwarg=None, action='list').get_query_cache_suffix(request)
+
+    def test_each_page_is_cached_under_its_own_cursor(self):
+        first = self.client.get('/patients/', {'page_size': 2}).json()
+        second = self.client.get(first['next']).json()
+        self.assertEqual(len(first['results']), 2)
+        self.assertEqual(len(second['results']), 1)
+        self.assertIsNone(second['next'])
+        seen = [row['id'] for row in first['results'] + second['results']]
+        self.assertCountEqual(seen, Patient.objects.values_list('id', flat=True))
+        # Served again from the cache, each cursor still gets its own page.
+        self.assertEqual(self.client.get(first['next']).json(), second)
+
+    def test_page_size_is_clamped_before_keying(self):
+        max_page_size = CreatedAtCursorPagination.max_page_size
+        self.assertEqual(self.cache_suffix(page_size=10000), self.cache_suffix(page_size=max_page_size))
+        self.assertEqual(self.cache_suffix(page_size='junk'), self.cache_suffix())
+        self.assertNotEqual(self.cache_suffix(page_size=10000), self.cache_suffix())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class WarmCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        patient = Patient.objects.create(
+            first_name='Almaz', last_name='Tesfaye', gender='F', contact_number='0911000000', assigned_doctor=cls.doctor,
+        )
+        appointment = Appointment.objects.create(patient=patient, doctor=cls.doctor, appointment_date=timezone.now())
+        Treatment.objects.create(patient=patient, doctor=cls.doctor, appointment=appointment, notes='Seen.')
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+        self.client = APIClient()
+
+    def get(self, user, path):
+        self.client.force_authenticate(user)
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200, path)
+        return response.content
+
+    def test_warmed_entries_match_what_requests_would_build(self):
+        requests = [
+            (self.doctor, '/appointments/today/'), (self.doctor, '/appointments/'),
+            (self.doctor, '/treatments/today/'), (self.doctor, '/treatments/'),
+            (self.receptionist, '/appointments/today/'), (self.receptionist, '/patients/'),
+        ]
+        call_command('warm_cache', base_url='http://testserver', stdout=StringIO())
+        cache_metrics.reset()
+        warmed = [self.get(user, path) for user, path in requests]
+        operations = [row['operations'] for row in cache_metrics.snapshot()['prefixes'].values()]
+        self.assertFalse([ops for ops in operations if 'rebuild' in ops])
+
+        cache.clear()
+        local_cache.clear()
+        self.assertEqual([self.get(user, path) for user, path in requests], warmed)
+
+
+class RenderedProbe(CacheResponseMixin):
+    cache_rendered_response = True
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RenderedResponseTests(SimpleTestCase):
+    payload = {'rows': [{'id': 1, 'amount': '500.00', 'name': 'Almaz'}], 'next': None}
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+        self.view = RenderedProbe()
+        self.key = versioned_key('probes', 'list')
+
+    def serve(self):
+        build = mock.Mock(return_value=self.payload)
+        return self.view.cached_response(self.key, build, 'probe'), build
+
+    def test_hits_return_the_rendered_body_unchanged(self):
+        first, build = self.serve()
+        build.assert_called_once()
+        self.assertEqual(first.content, JSONRenderer().render(self.payload))
+        for tier in ('local', 'redis'):
+            with self.subTest(tier=tier):
+                if tier == 'redis':
+                    local_cache.clear()
+                hit, build = self.serve()
+                build.assert_not_called()
+                self.assertEqual(hit.content, first.content)
+                self.assertEqual(hit['Content-Type'], 'application/json')
+                self.assertEqual(int(hit['Content-Length']), len(first.content))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class StaleCopyTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+        self.view = StaleProbe()
+
+    def store_then_supersede(self):
+        key = versioned_key('probes', 'list')
+        self.view.prime_cache(key, {'rows': [1]})
+        bump_namespaces('probes')
+        return versioned_key('probes', 'list')
+
+    def test_recent_copy_is_served_while_rebuilding(self):
+        key = self.store_then_supersede()
+        self.assertEqual(self.view._wait_for_rebuild(key, 'probe'), {'rows': [1]})
+
+    def test_copy_older_than_the_bound_is_not_served(self):
+        key = self.store_then_supersede()
+        later = time.time() + StaleProbe.cache_stale_ttl + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertIsNone(self.view._wait_for_rebuild(key, 'probe'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class NamespaceVersionReuseTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+
+    def bump_on_another_worker(self, namespace):
+        # Another worker's bump reaches Redis but not this worker's memory.
+        cache.incr(f"ns_version_{namespace}")
+
+    def test_next_access_sees_another_workers_write_by_default(self):
+        before = versioned_key('probes', 'list')
+        self.bump_on_another_worker('probes')
+        self.assertNotEqual(versioned_key('probes', 'list'), before)
+
+    def test_opt_in_window_reuses_the_local_version(self):
+        with mock.patch.object(local_versions, 'ttl', 5):
+            before = versioned_key('probes', 'list')
+            self.bump_on_another_worker('probes')
+            self.assertEqual(versioned_key('probes', 'list'), before)
+            bump_namespaces('probes')
+            self.assertNotEqual(versioned_key('probes', 'list'), before)
+
+
+class InvalidationProbe(CacheInvalidationMixin):
+    cache_namespaces_to_invalidate = ('appointments', 'treatments')
+    cache_patient_id_attr = 'patient_id'
+
+
+class DeferredInvalidationTests(TestCase):
+    def invalidate(self, *patient_ids):
+        view = InvalidationProbe()
+        for patient_id in patient_ids:
+            view._invalidate_cache(mock.Mock(patient_id=patient_id))
+        view._flush_cache_invalidations()
+
+    def test_one_bump_per_request_after_commit(self):
+        with mock.patch('core.cache.bump_namespaces') as bump:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    self.invalidate(1, 2, 1)
+                    bump.assert_not_called()
+        bump.assert_called_once()
+        self.assertCountEqual(
+            bump.call_args.args, ['appointments', 'treatments', patient_namespace(1), patient_namespace(2)]
+        )
+
+    def test_rolled_back_writes_bump_nothing(self):
+        with mock.patch('core.cache.bump_namespaces') as bump:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                with self.assertRaises(RuntimeError), transaction.atomic():
+                    self.invalidate(1)
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        bump.assert_not_called()
+
+
+class CacheMetricsTests(TestCase):
+    def setUp(self):
+        cache_metrics.reset()
+        cache_metrics.record('patients', 'hit', 0.002)
+        cache_metrics.record('patients', 'hit', 0.2)
+        cache_metrics.record('patients', 'set', 0.001, size=5000)
+
+    def test_snapshot_counts_and_buckets(self):
+        patients = cache_metrics.snapshot()['prefixes']['patients']
+        self.assertEqual(patients['operations'], {'hit': 2, 'set': 1})
+        hits = patients['latency_seconds']['hit']
+        self.assertEqual((hits['count'], hits['buckets']['0.0025'], hits['buckets']['+Inf']), (2, 1, 2))
+        self.assertEqual(patients['payload_bytes']['buckets']['4096'], 0)
+        self.assertEqual(patients['payload_bytes']['buckets']['16384'], 1)
+
+    def test_prometheus_text(self):
+        text = cache_metrics.render_text()
+        labels = f'pid="{os.getpid()}",prefix="patients"'
+        self.assertIn(f'cache_operations_total{{{labels},operation="hit"}} 2', text)
+        self.assertIn(f'cache_operation_seconds_bucket{{{labels},operation="hit",le="+Inf"}} 2', text)
+        self.assertIn(f'cache_payload_bytes_count{{{labels}}} 1', text)
+
+    def test_endpoint_is_for_admins_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create_user(username='reception', password='x', role='receptionist'))
+        self.assertEqual(client.get('/cache/metrics/').status_code, 403)
+        client.force_authenticate(User.objects.create_user(username='ops', password='x', role='admin', is_staff=True))
+        response = client.get('/cache/metrics/', {'format': 'prometheus'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'cache_operations_total', response.content)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PatientNamespaceTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        local_versions.clear()
+        cache_metrics.reset()
+
+    def test_patient_version_keys_expire(self):
+        with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            versioned_key(patient_namespace(7), 'timeline')
+        self.assertEqual(add.call_args.kwargs['timeout'], PATIENT_NAMESPACE_VERSION_TTL)
+
+    def test_shared_version_keys_do_not_expire(self):
+        with mock.patch.object(cache, 'add', wraps=cache.add) as add:
+            versioned_key('probes', 'list')
+        self.assertIsNone(add.call_args.kwargs['timeout'])
+
+    def test_patients_share_one_metrics_label(self):
+        view = StaleProbe()
+        for patient_id in (1, 2, 3):
+            key = versioned_key(patient_namespace(patient_id), 'timeline')
+            if patient_id == 3:
+                # Held by another request, so this one waits and then rebuilds.
+                acquire_lock(key, 5)
+            view.cached_response(key, lambda: {'rows': []}, 'probe')
+            bump_namespaces(patient_namespace(patient_id))
+        snapshot = cache_metrics.snapshot()['prefixes']
+        self.assertEqual(set(snapshot), {'patient'})
+        self.assertEqual(snapshot['patient']['operations']['rebuild'], 3)
+        self.assertEqual(snapshot['patient']['operations']['lock_wait_expired'], 1)
+
+
+class QueueStreamEntryPointTests(SimpleTestCase):
+    def test_wsgi_does_not_serve_the_stream(self):
+        response = Client().get('/queue/stream/')
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(response.streaming)
+
+    async def test_asgi_serves_the_stream(self):
+        # Reaches the stream's own authentication instead of the WSGI refusal.
+        response = await AsyncClient().get('/queue/stream/')
+        self.assertEqual(response.status_code, 401)
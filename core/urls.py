@@ -17,6 +17,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularRedocView, SpectacularSwaggerView
+from .views import CacheMetricsView, queue_stream
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -25,6 +26,8 @@ urlpatterns = [
     path('appointments/', include('appointments.urls')),
     path('treatments/', include('treatments.urls')),
     path('payments/', include('payments.urls')),
+    path('cache/metrics/', CacheMetricsView.as_view(), name='cache-metrics'),
+    path('queue/stream/', queue_stream, name='queue-stream'),
     # OpenAPI schema and documentation
     path('schema/', SpectacularAPIView.as_view(), name='schema'),
     path('schema/swagger-ui/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
@@ -0,0 +1,123 @@
+import json
+import asyncio
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import permissions, status
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.exceptions import AuthenticationFailed, NotAuthenticated, PermissionDenied
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from patients.models import Patient
+from patients.serializers import PatientQueueSerializer
+from appointments.models import Appointment
+from appointments.serializers import AppointmentQueueSerializer
+from .metrics import cache_metrics
+from .events import broker, RESYNC
+
+QUEUE_STREAM_ROLES = ('admin', 'receptionist', 'doctor')
+QUEUE_STREAM_HEARTBEAT = 15
+QUEUE_STREAM_RETRY_MS = 3000
+
+
+class PrometheusTextRenderer(BaseRenderer):
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, str):
+            return data.encode(self.charset)
+        return JSONRenderer().render(data)
+
+
+class CacheMetricsView(APIView):
+    """Per-worker cache counters and histograms.
+
+    JSON by default; ``?format=prometheus`` returns the text exposition format.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    renderer_classes = [JSONRenderer, PrometheusTextRenderer]
+
+    def get(self, request):
+        if request.accepted_renderer.format == 'prometheus':
+            return Response(cache_metrics.render_text())
+        return Response(cache_metrics.snapshot())
+
+
+def build_queue_snapshot(user):
+    """Today's queue as seen by ``user``: doctors only get their own rows."""
+    today = timezone.now().date()
+    patients = Patient.objects.filter(created_at__date=today).order_by('queue_number')
+    appointments = Appointment.objects.filter(appointment_date__date=today).order_by('appointment_date')
+    if user.role == 'doctor':
+        patients = patients.filter(assigned_doctor=user)
+        appointments = appointments.filter(doctor=user)
+    return {
+        'date': today,
+        'patients': PatientQueueSerializer(patients, many=True).data,
+        'appointments': AppointmentQueueSerializer(appointments, many=True).data,
+    }
+
+
+def _authenticate_stream(request):
+    # EventSource cannot set headers, so the access token may also come as ?token=.
+    authenticator = JWTAuthentication()
+    header = authenticator.get_header(request)
+    raw_token = authenticator.get_raw_token(header) if header else request.GET.get('token')
+    if not raw_token:
+        raise NotAuthenticated()
+    return authenticator.get_user(authenticator.get_validated_token(raw_token))
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+async def queue_stream(request):
+    """Server-sent events for the live queue board.
+
+    Sends a ``snapshot`` of today's queue, then one event per change
+    (registered, seen, cancelled, completed, treatment created). Only
+    served through ``core.asgi``, where each open stream is a coroutine
+    waiting on its queue. Under WSGI the stream would hold a worker until it
+    is killed, so the web process answers 404 instead.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {'detail': 'The queue stream is served by the stream process.'}, status=status.HTTP_404_NOT_FOUND
+        )
+    try:
+        user = await sync_to_async(_authenticate_stream)(request)
+    except (AuthenticationFailed, NotAuthenticated) as exc:
+        detail = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+        return JsonResponse(detail, status=status.HTTP_401_UNAUTHORIZED)
+    if getattr(user, 'role', None) not in QUEUE_STREAM_ROLES:
+        return JsonResponse({'detail': PermissionDenied.default_detail}, status=status.HTTP_403_FORBIDDEN)
+
+    async def events():
+        # Subscribe before the snapshot is read so no change falls in between.
+        queue = broker.subscribe()
+        try:
+            yield f"retry: {QUEUE_STREAM_RETRY_MS}\n\n"
+            yield _sse('snapshot', await sync_to_async(build_queue_snapshot)(user))
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), QUEUE_STREAM_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is RESYNC:
+                    yield _sse('snapshot', await sync_to_async(build_queue_snapshot)(user))
+                elif user.role != 'doctor' or message['doctor_id'] == user.id:
+                    yield _sse(message['event'], message['data'])
+        finally:
+            broker.unsubscribe(queue)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,67 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:59
+
+import re
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+BATCH_SIZE = 500
+SEARCH_FIELDS = ['first_name_normalized', 'last_name_normalized', 'contact_number_digits']
+
+
+def populate_search_fields(apps, schema_editor):
+    # Streamed and written in batches, so memory stays flat however many
+    # patients there are.
+    Patient = apps.get_model('patients', 'Patient')
+    patients = Patient.objects.only('first_name', 'last_name', 'contact_number').order_by('pk')
+    batch = []
+    for patient in patients.iterator(chunk_size=BATCH_SIZE):
+        patient.first_name_normalized = ' '.join(patient.first_name.split()).casefold()
+        patient.last_name_normalized = ' '.join(patient.last_name.split()).casefold()
+        patient.contact_number_digits = re.sub(r'\D', '', patient.contact_number)
+        batch.append(patient)
+        if len(batch) == BATCH_SIZE:
+            Patient.objects.bulk_update(batch, SEARCH_FIELDS)
+            batch = []
+    if batch:
+        Patient.objects.bulk_update(batch, SEARCH_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0003_dailyqueuecounter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='contact_number_digits',
+            field=models.CharField(default='', editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='first_name_normalized',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='last_name_normalized',
+            field=models.CharField(default='', editable=False, max_length=100),
+        ),
+        migrations.RunPython(populate_search_fields, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['last_name_normalized', 'first_name_normalized', 'contact_number_digits'], name='patient_name_phone_idx', opclasses=['varchar_pattern_ops', 'varchar_pattern_ops', 'varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['first_name_normalized'], name='patient_first_name_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['contact_number_digits'], name='patient_phone_digits_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -1,7 +1,56 @@
-from django.db import models
+import re
+from django.db import models, transaction, IntegrityError
 from django.conf import settings
 from django.utils import timezone
 
+
+def normalize_name(value):
+    """Trimmed, whitespace-collapsed, casefolded form used for lookups."""
+    return ' '.join((value or '').split()).casefold()
+
+
+def normalize_phone(value):
+    return re.sub(r'\D', '', value or '')
+
+
+class DailyQueueCounter(models.Model):
+    """Last queue number handed out on a given day.
+
+    The row is locked for the rest of the registering transaction, so numbers
+    are unique across workers and hosts, and a rolled-back registration gives
+    its number back instead of leaving a gap.
+    """
+    day = models.DateField(unique=True)
+    last_number = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.day}: {self.last_number}"
+
+    @classmethod
+    def allocate(cls, day, count=1):
+        """Reserve ``count`` consecutive numbers for ``day`` and return the first."""
+        with transaction.atomic():
+            counter = cls.objects.select_for_update().filter(day=day).first()
+            if counter is None:
+                counter = cls._create_for_day(day)
+            counter.last_number += count
+            counter.save(update_fields=['last_number'])
+            return counter.last_number - count + 1
+
+    @classmethod
+    def _create_for_day(cls, day):
+        # Seeded from existing rows so numbers handed out before the counter
+        # existed (e.g. earlier on the day this was deployed) are not reused.
+        last_number = Patient.objects.filter(created_at__date=day).aggregate(
+            models.Max('queue_number')
+        )['queue_number__max'] or 0
+        try:
+            with transaction.atomic():
+                return cls.objects.create(day=day, last_number=last_number)
+        except IntegrityError:
+            return cls.objects.select_for_update().get(day=day)
+
+
 class Patient(models.Model):
     GENDER_CHOICES = (
         ('M', 'Male'),
@@ -28,15 +77,52 @@ class Patient(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Derived on save; used by duplicate detection and /patients/search/.
+    first_name_normalized = models.CharField(max_length=100, editable=False, default='')
+    last_name_normalized = models.CharField(max_length=100, editable=False, default='')
+    contact_number_digits = models.CharField(max_length=20, editable=False, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='patient_created_at_idx'),
+            # Pattern opclasses (PostgreSQL only, ignored elsewhere) let the
+            # same indexes serve both exact matches and LIKE 'prefix%'.
+            models.Index(
+                fields=['last_name_normalized', 'first_name_normalized', 'contact_number_digits'],
+                name='patient_name_phone_idx',
+                opclasses=['varchar_pattern_ops'] * 3,
+            ),
+            models.Index(
+                fields=['first_name_normalized'],
+                name='patient_first_name_idx',
+                opclasses=['varchar_pattern_ops'],
+            ),
+            models.Index(
+                fields=['contact_number_digits'],
+                name='patient_phone_digits_idx',
+                opclasses=['varchar_pattern_ops'],
+            ),
+        ]
+
+    def set_search_fields(self):
+        self.first_name_normalized = normalize_name(self.first_name)
+        self.last_name_normalized = normalize_name(self.last_name)
+        self.contact_number_digits = normalize_phone(self.contact_number)
+
     def save(self, *args, **kwargs):
+        self.set_search_fields()
         # Auto-assign queue number per day
         if not self.queue_number:
-            today = timezone.now().date()
-            today_patients = Patient.objects.filter(created_at__date=today)
-            last_number = today_patients.aggregate(models.Max('queue_number'))['queue_number__max'] or 0
-            self.queue_number = last_number + 1
+            self.queue_number = DailyQueueCounter.allocate(timezone.now().date())
         super().save(*args, **kwargs)
 
+    @property
+    def load_key(self):
+        """``(doctor_id, day)`` this patient counts towards in DoctorLoad."""
+        if self.is_seen or self.assigned_doctor_id is None or self.created_at is None:
+            return None
+        return (self.assigned_doctor_id, self.created_at.date())
+
     @property
     def full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -1,10 +1,20 @@
+import uuid
+from decimal import Decimal
+from collections import Counter
 from rest_framework import serializers
-from .models import Patient
+from .models import Patient, DailyQueueCounter, normalize_name, normalize_phone
 from accounts.models import User
-from appointments.models import Appointment 
+from appointments.models import Appointment, DoctorLoad
 from django.utils import timezone
 from django.db import transaction
-from payments.serializers import PaymentCreateSerializer
+from payments.models import Payment
+from payments.serializers import PaymentSerializer, PaymentCreateSerializer, ServerConfigError
+from treatments.models import Treatment
+from treatments.permissions import can_read_treatment_contents
+
+BULK_REGISTRATION_LIMIT = 500
+TREATMENT_CONTENT_FIELDS = ('notes', 'prescription')
+INITIAL_APPOINTMENT_NOTES = 'Initial consultation upon registration.'
 
 class DoctorSerializer(serializers.ModelSerializer):
     class Meta:
@@ -47,9 +57,9 @@ class PatientSerializer(serializers.ModelSerializer):
 
     def _validate_unique_patient(self, first_name, last_name, phone):
         qs = Patient.objects.filter(
-            first_name__iexact=first_name.strip(),
-            last_name__iexact=last_name.strip(),
-            contact_number=phone
+            last_name_normalized=normalize_name(last_name),
+            first_name_normalized=normalize_name(first_name),
+            contact_number_digits=normalize_phone(phone),
         )
         if self.instance:
             qs = qs.exclude(pk=self.instance.pk)
@@ -60,23 +70,30 @@ class PatientSerializer(serializers.ModelSerializer):
         payment_method = validated_data.pop('payment_method')
         amount = validated_data.pop('amount', None)
 
-        if not validated_data.get('assigned_doctor'):
-            validated_data['assigned_doctor'] = User.objects.filter(role='doctor').first()
-
         with transaction.atomic():
+            day = timezone.now().date()
+            doctor = validated_data.get('assigned_doctor')
+            if doctor:
+                DoctorLoad.ensure_seeded(day)
+                DoctorLoad.adjust(doctor.id, day, pending=1, unseen=1)
+            else:
+                validated_data['assigned_doctor_id'] = DoctorLoad.assign(day)
             patient = super().create(validated_data)
             self._create_initial_appointment(patient)
             self._process_initial_payment(patient, amount, payment_method)
 
+        # The gateway is called once the registration has committed, so the
+        # queue counter and sequence rows are never locked across it.
+        self._start_checkout()
         return patient
 
     def _create_initial_appointment(self, patient):
-        Appointment.objects.create(
+        self.initial_appointment = Appointment.objects.create(
             patient=patient,
-            doctor=patient.assigned_doctor,
+            doctor_id=patient.assigned_doctor_id,
             appointment_date=timezone.now(),
             appointment_type='initial',
-            notes='Initial consultation upon registration.'
+            notes=INITIAL_APPOINTMENT_NOTES
         )
 
     def _process_initial_payment(self, patient, amount, payment_method):
@@ -85,10 +102,24 @@ class PatientSerializer(serializers.ModelSerializer):
             "amount": str(amount),
             "payment_method": payment_method,
         }
-        pay_serializer = PaymentCreateSerializer(data=pay_input, context=self.context)
+        pay_serializer = PaymentCreateSerializer(data=pay_input, context={**self.context, 'defer_checkout': True})
         pay_serializer.is_valid(raise_exception=True)
-        payment = pay_serializer.save()
+        self._payment = pay_serializer.save()
+        self._pay_serializer = pay_serializer
+
+    def _start_checkout(self):
+        payment, pay_serializer = self._payment, self._pay_serializer
+        error = None
+        if payment.payment_method == 'chapa':
+            try:
+                pay_serializer.start_checkout(payment)
+            except (serializers.ValidationError, ServerConfigError):
+                # The patient stays registered with a failed payment, which
+                # the desk can retry through POST /payments/.
+                error = 'Could not start the Chapa checkout; retry the payment.'
         self._payment_info = pay_serializer.build_response(payment)
+        if error:
+            self._payment_info['error'] = error
 
     def update(self, instance, validated_data):
         assigned_doctor = validated_data.pop('assigned_doctor', None)
@@ -105,3 +136,247 @@ class PatientSerializer(serializers.ModelSerializer):
         if hasattr(self, "_payment_info"):
             rep["payment"] = self._payment_info
         return rep
+
+
+class PatientQueueSerializer(serializers.ModelSerializer):
+    """Compact patient shape used by the live queue board."""
+    class Meta:
+        model = Patient
+        fields = ['id', 'first_name', 'last_name', 'queue_number', 'assigned_doctor', 'is_seen', 'created_at']
+
+
+class TimelineAppointmentSerializer(serializers.ModelSerializer):
+    doctor = DoctorSerializer(read_only=True)
+    display_id = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = Appointment
+        fields = [
+            'id', 'display_id', 'doctor', 'appointment_date', 'appointment_type',
+            'case_followup_seq', 'treatment', 'notes', 'status', 'created_at',
+        ]
+
+
+class TimelineTreatmentSerializer(serializers.ModelSerializer):
+    """A treatment inside a timeline or case.
+
+    ``notes`` and ``prescription`` are left out unless the requesting user
+    (``context['request']``) is the doctor who wrote the treatment.
+    """
+    doctor = DoctorSerializer(read_only=True)
+
+    class Meta:
+        model = Treatment
+        fields = ['id', 'doctor', 'appointment', 'notes', 'prescription', 'follow_up_required', 'created_at']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        request = self.context.get('request')
+        if not can_read_treatment_contents(getattr(request, 'user', None), instance):
+            for field in TREATMENT_CONTENT_FIELDS:
+                data.pop(field)
+        return data
+
+
+class PatientTimelineSerializer(serializers.Serializer):
+    """A patient's full history grouped into cases.
+
+    Each case is an initial appointment with its treatment and follow-up
+    chain; cases moved out by ``archive_appointments`` are included and
+    marked ``archived``. Expects ``appointments``, ``archived_appointments``
+    (with ``doctor``), ``treatments``, ``archived_treatments`` (with
+    ``doctor``) and ``payments`` to be prefetched; it runs no queries itself.
+    Treatment contents follow ``TimelineTreatmentSerializer``, so pass the
+    request in the context.
+    """
+
+    def to_representation(self, patient):
+        cases = self._cases(patient.appointments.all(), patient.treatments.all(), archived=False)
+        cases += self._cases(patient.archived_appointments.all(), patient.archived_treatments.all(), archived=True)
+        cases.sort(key=lambda pair: (pair[0].appointment_date, pair[0].id))
+        return {
+            'patient': PatientSerializer(patient).data,
+            'cases': [case for _, case in cases],
+            'payments': PaymentSerializer(patient.payments.all(), many=True).data,
+        }
+
+    def _cases(self, appointments, treatments, archived):
+        # Archived rows keep the live columns and ids, so the same
+        # serializers render both.
+        treatments = {treatment.appointment_id: treatment for treatment in treatments}
+        follow_ups = {}
+        for appointment in appointments:
+            if appointment.appointment_type == 'follow_up':
+                follow_ups.setdefault(appointment.initial_appointment_id, []).append(appointment)
+
+        cases = []
+        for appointment in appointments:
+            if appointment.appointment_type != 'initial':
+                continue
+            treatment = treatments.get(appointment.id)
+            cases.append((appointment, {
+                'appointment': TimelineAppointmentSerializer(appointment).data,
+                'treatment': TimelineTreatmentSerializer(treatment, context=self.context).data if treatment else None,
+                'follow_ups': TimelineAppointmentSerializer(follow_ups.get(appointment.id, []), many=True).data,
+                'archived': archived,
+            }))
+        return cases
+
+
+class PatientBulkRowSerializer(serializers.ModelSerializer):
+    """Field-level validation for one bulk row; runs no queries."""
+    assigned_doctor_id = serializers.IntegerField(required=False, allow_null=True)
+    payment_method = serializers.ChoiceField(
+        choices=(('cash', 'cash'),),
+        error_messages={'invalid_choice': 'Bulk registration accepts cash payments only.'},
+    )
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+    class Meta:
+        model = Patient
+        fields = [
+            'first_name', 'last_name', 'date_of_birth', 'gender',
+            'contact_number', 'address', 'assigned_doctor_id',
+            'payment_method', 'amount',
+        ]
+
+
+class PatientBulkRegistrationSerializer(serializers.Serializer):
+    """Register many walk-in patients with cash payments in one transaction.
+
+    Rows are validated together: doctors and existing patients are looked up
+    with one query each, queue numbers and ``type_seq`` values are reserved
+    with one call each, and patients, initial appointments and payments are written
+    with ``bulk_create``. Invalid rows are reported and skipped; ``save()``
+    returns one result per input row, in order.
+    """
+    patients = serializers.ListField(
+        child=serializers.DictField(), allow_empty=False, max_length=BULK_REGISTRATION_LIMIT
+    )
+
+    def create(self, validated_data):
+        rows = validated_data['patients']
+        self.results = [None] * len(rows)
+        self.registered = []
+        valid = {}
+        for index, row in enumerate(rows):
+            row_serializer = PatientBulkRowSerializer(data=row)
+            if row_serializer.is_valid():
+                valid[index] = row_serializer.validated_data
+            else:
+                self._reject(index, row_serializer.errors)
+
+        self._resolve_doctors(valid)
+        self._check_duplicates(valid)
+        if valid:
+            self._register(valid)
+        return self.results
+
+    @property
+    def created_count(self):
+        return sum(1 for result in self.results if result['status'] == 'created')
+
+    def _reject(self, index, errors):
+        self.results[index] = {'index': index, 'status': 'error', 'errors': errors}
+
+    def _resolve_doctors(self, valid):
+        # Rows without a doctor are assigned by load in _register, once the
+        # batch is known to be valid; here only their existence is checked.
+        requested = {attrs['assigned_doctor_id'] for attrs in valid.values() if attrs.get('assigned_doctor_id')}
+        known = set(User.objects.filter(role='doctor', pk__in=requested).values_list('pk', flat=True)) if requested else set()
+        unassigned = any(not attrs.get('assigned_doctor_id') for attrs in valid.values())
+        any_doctor = unassigned and User.objects.filter(role='doctor', is_active=True).exists()
+
+        for index, attrs in list(valid.items()):
+            doctor_id = attrs.get('assigned_doctor_id')
+            if doctor_id and doctor_id not in known:
+                message = f'Invalid pk "{doctor_id}" - object does not exist.'
+            elif not doctor_id and not any_doctor:
+                message = 'No doctor available.'
+            else:
+                continue
+            self._reject(index, {'assigned_doctor_id': [message]})
+            del valid[index]
+
+    def _check_duplicates(self, valid):
+        keys = {
+            index: (
+                normalize_name(attrs['last_name']),
+                normalize_name(attrs['first_name']),
+                normalize_phone(attrs['contact_number']),
+            )
+            for index, attrs in valid.items()
+        }
+        existing = set(Patient.objects.filter(
+            last_name_normalized__in={key[0] for key in keys.values()},
+            contact_number_digits__in={key[2] for key in keys.values()},
+        ).values_list('last_name_normalized', 'first_name_normalized', 'contact_number_digits'))
+
+        seen = {}
+        for index, key in keys.items():
+            if key in existing:
+                self._reject(index, {'non_field_errors': ['Patient already exists.']})
+            elif key in seen:
+                self._reject(index, {'non_field_errors': [f'Duplicate of row {seen[key]} in this batch.']})
+            else:
+                seen[key] = index
+                continue
+            del valid[index]
+
+    def _register(self, valid):
+        now = timezone.now()
+        with transaction.atomic():
+            first_queue_number = DailyQueueCounter.allocate(now.date(), count=len(valid))
+            type_seqs = Appointment.next_type_seqs('initial', count=len(valid))
+            self._assign_doctors(now.date(), valid.values())
+
+            patients, payment_amounts = [], []
+            for offset, attrs in enumerate(valid.values()):
+                payment_amounts.append(attrs.pop('amount'))
+                attrs.pop('payment_method')
+                patient = Patient(queue_number=first_queue_number + offset, **attrs)
+                patient.set_search_fields()
+                patients.append(patient)
+            Patient.objects.bulk_create(patients)
+
+            appointments = Appointment.objects.bulk_create([
+                Appointment(
+                    patient=patient,
+                    doctor_id=patient.assigned_doctor_id,
+                    appointment_date=now,
+                    appointment_type='initial',
+                    type_seq=type_seq,
+                    notes=INITIAL_APPOINTMENT_NOTES,
+                )
+                for patient, type_seq in zip(patients, type_seqs)
+            ])
+            payments = Payment.objects.bulk_create([
+                Payment(patient=patient, amount=amount, payment_method='cash', reference=str(uuid.uuid4()), status='paid')
+                for patient, amount in zip(patients, payment_amounts)
+            ])
+
+        doctors = User.objects.in_bulk({patient.assigned_doctor_id for patient in patients})
+        for patient in patients:
+            patient.assigned_doctor = doctors[patient.assigned_doctor_id]
+        self.registered = list(zip(patients, appointments))
+        for index, patient, appointment, payment in zip(valid, patients, appointments, payments):
+            self.results[index] = {
+                'index': index,
+                'status': 'created',
+                'patient': PatientSerializer(patient).data,
+                'appointment': {'id': appointment.id, 'display_id': appointment.display_id},
+                'payment': {'id': payment.id, 'reference': payment.reference, 'status': payment.status},
+            }
+
+    def _assign_doctors(self, day, rows):
+        rows = list(rows)
+        chosen = Counter(attrs['assigned_doctor_id'] for attrs in rows if attrs.get('assigned_doctor_id'))
+        if chosen:
+            DoctorLoad.ensure_seeded(day)
+        for doctor_id, registrations in chosen.items():
+            DoctorLoad.adjust(doctor_id, day, pending=registrations, unseen=registrations)
+
+        unassigned = [attrs for attrs in rows if not attrs.get('assigned_doctor_id')]
+        if unassigned:
+            for attrs, doctor_id in zip(unassigned, DoctorLoad.assign_many(day, len(unassigned))):
+                attrs['assigned_doctor_id'] = doctor_id
@@ -1,3 +1,269 @@
-from django.test import TestCase
+import threading
+from io import StringIO
+from datetime import timedelta
+from unittest import mock
+import requests
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.test import APIClient
+from accounts.models import User
+from appointments.models import Appointment
+from core.cache import local_cache
+from payments.models import Payment
+from treatments.models import Treatment
+from .models import Patient, DailyQueueCounter
 
-# Create your tests here.
+
+def make_patient(**kwargs):
+    fields = {'first_name': 'Abebe', 'last_name': 'Kebede', 'gender': 'M', 'contact_number': '0911000000'}
+    fields.update(kwargs)
+    return Patient.objects.create(**fields)
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PatientSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        cls.almaz = make_patient(first_name='Almaz', last_name='Tesfaye', contact_number='+251 911-234-567')
+        cls.abebe = make_patient(first_name='  Abebe ', last_name='KEBEDE', contact_number='0922 000 111')
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+
+    def search(self, term):
+        response = self.client.get('/patients/search/', {'q': term})
+        self.assertEqual(response.status_code, 200, response.content)
+        return {row['id'] for row in response.json()}
+
+    def test_name_prefixes_ignore_case_spacing_and_order(self):
+        self.assertEqual(self.search('keb'), {self.abebe.pk})
+        self.assertEqual(self.search('abebe  kebede'), {self.abebe.pk})
+        self.assertEqual(self.search('Tesfaye Alm'), {self.almaz.pk})
+
+    def test_phone_prefixes_ignore_formatting(self):
+        self.assertEqual(self.search('251-911'), {self.almaz.pk})
+        self.assertEqual(self.search('0922 00'), {self.abebe.pk})
+        self.assertEqual(self.search('0933'), set())
+
+    def test_short_terms_are_rejected(self):
+        self.assertEqual(self.client.get('/patients/search/', {'q': ' a '}).status_code, 400)
+
+
+class DailyQueueCounterTests(TestCase):
+    def test_numbers_are_sequential_within_a_day(self):
+        numbers = [make_patient(contact_number=f'09110000{i:02d}').queue_number for i in range(5)]
+        self.assertEqual(numbers, [1, 2, 3, 4, 5])
+        self.assertEqual(DailyQueueCounter.objects.get(day=timezone.now().date()).last_number, 5)
+
+    def test_counter_is_seeded_from_numbers_already_issued_today(self):
+        make_patient(queue_number=7)
+        self.assertEqual(make_patient(contact_number='0911000001').queue_number, 8)
+
+    def test_each_day_starts_again_at_one(self):
+        yesterday = timezone.now().date() - timedelta(days=1)
+        DailyQueueCounter.objects.create(day=yesterday, last_number=42)
+        self.assertEqual(make_patient().queue_number, 1)
+
+    def test_rolled_back_registration_returns_its_number(self):
+        make_patient()
+        try:
+            with transaction.atomic():
+                make_patient(contact_number='0911000001')
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEqual(make_patient(contact_number='0911000002').queue_number, 2)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class DailyQueueCounterConcurrencyTests(TransactionTestCase):
+    workers = 8
+    per_worker = 10
+
+    def test_concurrent_registrations_get_unique_gap_free_numbers(self):
+        barrier = threading.Barrier(self.workers)
+        errors = []
+
+        def register(worker):
+            try:
+                barrier.wait()
+                for i in range(self.per_worker):
+                    with transaction.atomic():
+                        make_patient(contact_number=f'09{worker:02d}{i:06d}')
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=register, args=(w,)) for w in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        numbers = sorted(Patient.objects.values_list('queue_number', flat=True))
+        self.assertEqual(numbers, list(range(1, self.workers * self.per_worker + 1)))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class BulkRegistrationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        make_patient(first_name='Almaz', last_name='Tesfaye', contact_number='0911000001')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+
+    def row(self, first_name, contact_number, **extra):
+        row = {
+            'first_name': first_name, 'last_name': 'Tesfaye', 'gender': 'F',
+            'contact_number': contact_number, 'payment_method': 'cash', 'amount': '500.00',
+        }
+        row.update(extra)
+        return row
+
+    def register(self, *rows):
+        return self.client.post('/patients/bulk/', {'patients': list(rows)}, format='json')
+
+    def test_partial_failure_registers_the_valid_rows(self):
+        response = self.register(
+            self.row('Hanna', '0911000002'),
+            self.row('Almaz', '0911 000 001'),  # Already registered.
+            self.row('Selam', '0911000003', payment_method='chapa'),
+            self.row('Hanna', '0911000002'),  # Repeats row 0.
+            self.row('Tigist', '0911000004', assigned_doctor_id=self.doctor.pk),
+        )
+        self.assertEqual(response.status_code, 201)
+        payload = response.json()
+        self.assertEqual((payload['created'], payload['failed']), (2, 3))
+        self.assertEqual(
+            [result['status'] for result in payload['results']], ['created', 'error', 'error', 'error', 'created']
+        )
+        self.assertIn('payment_method', payload['results'][2]['errors'])
+        created = Patient.objects.filter(first_name__in=['Hanna', 'Tigist'])
+        self.assertEqual(created.count(), 2)
+        self.assertEqual(Payment.objects.filter(patient__in=created, status='paid').count(), 2)
+        self.assertEqual(len(set(created.values_list('queue_number', flat=True))), 2)
+
+    def test_all_rows_failing_is_a_bad_request(self):
+        response = self.register(self.row('Almaz', '0911000001'), self.row('Selam', '0911000003', amount='0'))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual((response.json()['created'], response.json()['failed']), (0, 2))
+        self.assertFalse(Patient.objects.filter(first_name='Selam').exists())
+
+
+@override_settings(
+    CHAPA_SECRET_KEY='test-secret', DEFAULT_PAYMENT_EMAIL='desk@example.com',
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+)
+class RegistrationCheckoutTests(TransactionTestCase):
+    """The Chapa call must not run inside the registering transaction.
+
+    Runs on any database: the counter row locks are released at commit, so
+    a gateway call made outside any atomic block cannot hold them.
+    """
+
+    def setUp(self):
+        User.objects.create_user(username='dr_abebe', password='x', role='doctor')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(username='reception', password='x', role='receptionist'))
+
+    def register(self):
+        return self.client.post('/patients/', {
+            'first_name': 'Almaz', 'last_name': 'Tesfaye', 'gender': 'F',
+            'contact_number': '0911000000', 'payment_method': 'chapa', 'amount': '500.00',
+        }, format='json')
+
+    def test_checkout_starts_after_the_registration_commits(self):
+        in_transaction = []
+
+        def post(*args, **kwargs):
+            in_transaction.append(connection.in_atomic_block)
+            return mock.Mock(status_code=200, json=lambda: {
+                'status': 'success', 'data': {'checkout_url': 'https://checkout.example/pay'},
+            })
+
+        with mock.patch('payments.serializers.requests.post', side_effect=post):
+            response = self.register()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(in_transaction, [False])
+        self.assertEqual(response.json()['payment']['payment_url'], 'https://checkout.example/pay')
+
+    def test_unreachable_gateway_keeps_the_registration(self):
+        with mock.patch('payments.serializers.requests.post', side_effect=requests.ConnectionError):
+            response = self.register()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['payment']['status'], 'failed')
+        self.assertTrue(Patient.objects.filter(pk=response.json()['id']).exists())
+        self.assertEqual(Payment.objects.get().status, 'failed')
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class PatientTimelineTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor = User.objects.create_user(username='dr_selam', password='x', role='doctor')
+        cls.receptionist = User.objects.create_user(username='reception', password='x', role='receptionist')
+        cls.other_doctor = User.objects.create_user(username='dr_tigist', password='x', role='doctor')
+        cls.patient = make_patient(assigned_doctor=cls.doctor)
+
+    def setUp(self):
+        cache.clear()
+        local_cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.receptionist)
+
+    def add_case(self, when, status, doctor=None):
+        doctor = doctor or self.doctor
+        initial = Appointment.objects.create(
+            patient=self.patient, doctor=doctor, appointment_date=when, status=status,
+        )
+        Treatment.objects.create(
+            patient=self.patient, doctor=doctor, appointment=initial, notes='Seen.', prescription='Rest.',
+        )
+        return initial
+
+    def timeline_treatments(self, user):
+        self.client.force_authenticate(user)
+        cases = self.client.get(f'/patients/{self.patient.pk}/timeline/').json()['cases']
+        return {case['appointment']['id']: case['treatment'] for case in cases}
+
+    def test_receptionist_does_not_receive_treatment_contents(self):
+        initial = self.add_case(timezone.now(), 'pending')
+        treatment = self.timeline_treatments(self.receptionist)[initial.pk]
+        self.assertEqual(treatment['doctor']['id'], self.doctor.pk)
+        self.assertNotIn('notes', treatment)
+        self.assertNotIn('prescription', treatment)
+
+    def test_doctors_receive_only_their_own_treatment_contents(self):
+        own = self.add_case(timezone.now(), 'pending')
+        other = self.add_case(timezone.now(), 'pending', doctor=self.other_doctor)
+        # Cached after the receptionist's request; doctors must not share it.
+        self.timeline_treatments(self.receptionist)
+        treatments = self.timeline_treatments(self.doctor)
+        self.assertEqual((treatments[own.pk]['notes'], treatments[own.pk]['prescription']), ('Seen.', 'Rest.'))
+        self.assertNotIn('notes', treatments[other.pk])
+        self.assertNotIn('prescription', treatments[other.pk])
+
+    def test_archived_cases_stay_on_the_timeline(self):
+        old = self.add_case(timezone.now() - timedelta(days=400), 'completed')
+        current = self.add_case(timezone.now(), 'pending')
+        call_command('archive_appointments', stdout=StringIO())
+        self.assertFalse(Appointment.objects.filter(pk=old.pk).exists())
+
+        cases = self.client.get(f'/patients/{self.patient.pk}/timeline/').json()['cases']
+        self.assertEqual(
+            [(case['appointment']['id'], case['archived'], case['treatment'] is not None) for case in cases],
+            [(old.pk, True, True), (current.pk, False, True)],
+        )
@@ -2,27 +2,42 @@ import logging
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import get_object_or_404
+from django.db.models import Q, Prefetch
 from django.utils import timezone
 from django.conf import settings
-from .models import Patient
-from .serializers import PatientSerializer
+from .models import Patient, normalize_name, normalize_phone
+from .serializers import (
+    PatientSerializer, PatientBulkRegistrationSerializer, PatientQueueSerializer, PatientTimelineSerializer,
+)
 from .permissions import IsReceptionist, IsAdminOrReceptionist, IsAdminRecDoctor
 from core.mixins import CacheResponseMixin, CacheInvalidationMixin
+from core.cache import PATIENTS, APPOINTMENTS, TREATMENTS, PAYMENTS, patient_namespace
+from core.events import queue_event, publish_queue_events, PATIENT_REGISTERED, PATIENT_SEEN
+from appointments.models import Appointment, ArchivedAppointment, DoctorLoad
+from treatments.models import Treatment, ArchivedTreatment
+from payments.models import Payment
+from appointments.serializers import AppointmentQueueSerializer
 
 logger = logging.getLogger(__name__)
+SEARCH_MIN_LENGTH = 2
+SEARCH_LIMIT = 20
 
 
 class PatientViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all().select_related('assigned_doctor').order_by('-created_at')
     serializer_class = PatientSerializer
     cache_key_prefix = "patient"
+    cache_namespaces_to_invalidate = (PATIENTS, APPOINTMENTS, TREATMENTS, PAYMENTS)
+    cache_patient_id_attr = 'id'
 
     def get_permissions(self):
-        if self.action in ['create', 'update', 'partial_update']:
+        if self.action in ['create', 'bulk', 'update', 'partial_update']:
             permission_classes = [IsReceptionist]
-        elif self.action == 'list':
+        elif self.action in ['list', 'search']:
             permission_classes = [IsAdminOrReceptionist]
-        elif self.action == 'retrieve':
+        elif self.action in ['retrieve', 'timeline']:
             permission_classes = [IsAdminRecDoctor]
         elif self.action == 'destroy':
             permission_classes = [permissions.IsAdminUser]
@@ -30,36 +45,121 @@ class PatientViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelV
             permission_classes = [permissions.IsAuthenticated]
         return [p() for p in permission_classes]
 
-    def get_cache_keys_to_invalidate(self, instance):
-        today = timezone.now().date().isoformat()
-        keys = [
-            "all_patients",
-            "all_appointments",
-            "all_treatments",
-            f"appointments_today_all_{today}",
-            f"treatments_today_{today}"
-        ]
-        
-        if instance.pk:
-            keys.append(f"patient_{instance.pk}")
-            
-        if getattr(instance, 'assigned_doctor', None):
-            keys.append(f"appointments_today_doctor_{instance.assigned_doctor.id}_{today}")
-        
-        if self.action == 'destroy':
-            self._add_appointment_cache_keys(instance, keys)
-        
-        return list(set(keys))
-
-    def _add_appointment_cache_keys(self, patient, keys):
-        for appt in patient.appointments.all():
-            if appt.doctor:
-                appt_date = appt.appointment_date.date().isoformat()
-                keys.append(f"appointments_today_doctor_{appt.doctor.id}_{appt_date}")
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        publish_queue_events(
+            self._registered_event(serializer.instance, getattr(serializer, 'initial_appointment', None))
+        )
+
+    def perform_update(self, serializer):
+        was_seen = serializer.instance.is_seen
+        load_key = serializer.instance.load_key
+        super().perform_update(serializer)
+        patient = serializer.instance
+        DoctorLoad.track(load_key, patient.load_key, 'unseen')
+        if patient.is_seen and not was_seen:
+            publish_queue_events(queue_event(
+                PATIENT_SEEN, {'patient': PatientQueueSerializer(patient).data}, patient.assigned_doctor_id
+            ))
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        # The delete cascades to appointments; recounting is simpler than
+        # tracking each one and deletes are rare.
+        DoctorLoad.recount(timezone.now().date())
+
+    def _registered_event(self, patient, appointment):
+        data = {
+            'patient': PatientQueueSerializer(patient).data,
+            'appointment': AppointmentQueueSerializer(appointment).data if appointment else None,
+        }
+        return queue_event(PATIENT_REGISTERED, data, patient.assigned_doctor_id)
 
     @action(detail=False, methods=['get'])
     def today(self, request):
         today_date = timezone.now().date()
         queryset = self.get_queryset().filter(created_at__date=today_date)
         serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+    @action(detail=True, methods=['get'])
+    def timeline(self, request, pk=None):
+        # Keyed in the patient's own namespace, which writes to the patient or
+        # any of their appointments, treatments and payments invalidate.
+        # Treatment contents depend on who asks, so doctors get their own entry.
+        user = request.user
+        scope = f"_doctor_{user.id}" if getattr(user, 'role', None) == 'doctor' else "_staff"
+        cache_key = self.make_cache_key(f"patient_timeline_{pk}{scope}", namespace=patient_namespace(pk))
+
+        def build_payload():
+            patient = get_object_or_404(self.get_timeline_queryset(), pk=pk)
+            self.check_object_permissions(request, patient)
+            return PatientTimelineSerializer(patient, context=self.get_serializer_context()).data
+
+        return self.cached_response(cache_key, build_payload, f"patient.timeline id={pk}")
+
+    def get_timeline_queryset(self):
+        return Patient.objects.select_related('assigned_doctor').prefetch_related(
+            Prefetch(
+                'appointments',
+                queryset=Appointment.objects.select_related('doctor').order_by('appointment_date', 'id'),
+            ),
+            Prefetch('treatments', queryset=Treatment.objects.select_related('doctor')),
+            Prefetch(
+                'archived_appointments',
+                queryset=ArchivedAppointment.objects.select_related('doctor').order_by('appointment_date', 'id'),
+            ),
+            Prefetch('archived_treatments', queryset=ArchivedTreatment.objects.select_related('doctor')),
+            Prefetch('payments', queryset=Payment.objects.order_by('created_at')),
+        )
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        serializer = PatientBulkRegistrationSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        results = serializer.save()
+        created = serializer.created_count
+        if created:
+            self._invalidate_cache(None)
+            publish_queue_events(*(
+                self._registered_event(patient, appointment) for patient, appointment in serializer.registered
+            ))
+        return Response(
+            {'created': created, 'failed': len(results) - created, 'results': results},
+            status=status.HTTP_201_CREATED if created else status.HTTP_400_BAD_REQUEST,
+        )
+
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        term = request.query_params.get('q', '')
+        normalized = normalize_name(term) if self._is_name_term(term) else normalize_phone(term)
+        if len(normalized) < SEARCH_MIN_LENGTH:
+            raise ValidationError({'q': f"Enter at least {SEARCH_MIN_LENGTH} characters."})
+        cache_key = self.make_cache_key(f"patient_search{self.get_query_cache_suffix(request)}")
+
+        def build_payload():
+            queryset = self.get_search_queryset(term).order_by('last_name_normalized', 'first_name_normalized')
+            return self.get_serializer(queryset[:SEARCH_LIMIT], many=True).data
+
+        return self.cached_response(cache_key, build_payload, "patient.search")
+
+    def get_search_queryset(self, term):
+        # Prefix matches only, so every branch stays on the normalized indexes.
+        queryset = self.get_queryset()
+        if not self._is_name_term(term):
+            return queryset.filter(contact_number_digits__startswith=normalize_phone(term))
+
+        words = normalize_name(term).split(' ', 1)
+        if len(words) == 1:
+            return queryset.filter(
+                Q(first_name_normalized__startswith=words[0]) | Q(last_name_normalized__startswith=words[0])
+            )
+        first, last = words
+        return queryset.filter(
+            Q(first_name_normalized__startswith=first, last_name_normalized__startswith=last)
+            | Q(first_name_normalized__startswith=last, last_name_normalized__startswith=first)
+        )
+
+    @staticmethod
+    def _is_name_term(term):
+        return any(ch.isalpha() for ch in term)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('patients', '0002_patient_created_at_idx'),
+        ('payments', '0002_payment_uniq_paid_payment_per_patient'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['created_at'], name='payment_created_at_idx'),
+        ),
+    ]
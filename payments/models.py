@@ -35,3 +35,6 @@ class Payment(models.Model):
                 name='uniq_paid_payment_per_patient',
             ),
         ]
+        indexes = [
+            models.Index(fields=['created_at'], name='payment_created_at_idx'),
+        ]
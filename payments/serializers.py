@@ -69,8 +69,24 @@ class PaymentCreateSerializer(serializers.ModelSerializer):
             payment.save(update_fields=["status", "updated_at"])
             return payment
 
+        if self.context.get("defer_checkout"):
+            # The caller opens the checkout with start_checkout once its
+            # transaction has committed; only the configuration is checked here.
+            self._check_chapa_config()
+            return payment
+        return self._initialize_chapa_payment(payment)
+
+    def start_checkout(self, payment):
+        """Open the Chapa checkout for a payment created with ``defer_checkout``."""
         return self._initialize_chapa_payment(payment)
 
+    def _check_chapa_config(self):
+        if not get_chapa_secret_key():
+            raise ServerConfigError("CHAPA_SECRET_KEY not configured")
+        email = getattr(settings, "DEFAULT_PAYMENT_EMAIL", None)
+        if not email or "@" not in email:
+            raise ServerConfigError("DEFAULT_PAYMENT_EMAIL not configured")
+
     def _initialize_chapa_payment(self, payment):
         secret_key = get_chapa_secret_key()
         if not secret_key:
@@ -16,6 +16,7 @@ class PaymentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelV
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
     cache_key_prefix = "payment"
+    cache_patient_id_attr = 'patient_id'
 
     def get_permissions(self):
         if self.action == 'webhook':
@@ -29,14 +30,6 @@ class PaymentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelV
             return PaymentWebhookSerializer
         return PaymentSerializer
 
-    def get_cache_keys_to_invalidate(self, instance):
-        return [
-            "all_payments", 
-            f"payment_{instance.id}",
-            "payment_total_amount",
-            "payment_today_total"
-        ]
-
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 07:35
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('appointments', '0008_archivedappointment_treatment'),
+        ('patients', '0004_patient_search_fields'),
+        ('treatments', '0004_archivedtreatment'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='treatment',
+            index=models.Index(fields=['doctor', 'created_at'], name='treatment_doctor_created_idx'),
+        ),
+    ]
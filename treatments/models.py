@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from patients.models import Patient
 from appointments.models import Appointment
 
@@ -25,7 +26,30 @@ class Treatment(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['appointment'], name='unique_treatment_per_appointment')
         ]
+        indexes = [
+            models.Index(fields=['created_at'], name='treatment_created_at_idx'),
+            # Serves a doctor's history newest first, and their day's treatments.
+            models.Index(fields=['doctor', 'created_at'], name='treatment_doctor_created_idx'),
+        ]
 
     def __str__(self):
         name = getattr(self.patient, 'full_name', f'{self.patient.first_name} {self.patient.last_name}')
         return f"Treatment for {name} by Dr. {self.doctor.username}"
+
+
+class ArchivedTreatment(models.Model):
+    """A treatment archived together with its case; same columns and ids as ``Treatment``."""
+    id = models.BigIntegerField(primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='archived_treatments')
+    doctor = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='archived_treatments')
+    appointment = models.ForeignKey(
+        'appointments.ArchivedAppointment', on_delete=models.CASCADE, null=True, blank=True, related_name='treatments'
+    )
+    notes = models.TextField()
+    prescription = models.TextField(blank=True, null=True)
+    follow_up_required = models.BooleanField(default=False)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Archived treatment {self.id} for {self.patient.first_name}"
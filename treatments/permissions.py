@@ -5,3 +5,12 @@ class IsDoctor(permissions.BasePermission):
         if request.method in permissions.SAFE_METHODS:
             return request.user.is_authenticated
         return getattr(request.user, 'role', None) == 'doctor'
+
+
+def can_read_treatment_contents(user, treatment):
+    """Whether ``user`` may see a treatment's notes and prescription.
+
+    Only the doctor who wrote it may, matching how ``/treatments/`` scopes
+    doctors to their own rows.
+    """
+    return getattr(user, 'role', None) == 'doctor' and treatment.doctor_id == user.id
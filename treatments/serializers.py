@@ -1,10 +1,18 @@
 from rest_framework import serializers
 from .models import Treatment
+from appointments.models import Appointment
 from patients.serializers import PatientSerializer, DoctorSerializer
 
 class TreatmentSerializer(serializers.ModelSerializer):
     patient_name = serializers.CharField(source='patient.full_name', read_only=True)
     doctor_name = serializers.CharField(source='doctor.username', read_only=True)
+    # The case's initial appointment and patient come with the appointment,
+    # so resolving the case on a write needs no further queries.
+    appointment = serializers.PrimaryKeyRelatedField(
+        queryset=Appointment.objects.select_related('patient', 'initial_appointment__patient'),
+        required=False,
+        allow_null=True,
+    )
 
     class Meta:
         model = Treatment
@@ -56,3 +64,15 @@ class TreatmentSerializer(serializers.ModelSerializer):
         if request and getattr(request.user, 'role', None) == 'doctor':
             if initial.doctor_id != request.user.id:
                 raise serializers.ValidationError({"appointment": "You can only manage treatments for your own appointments."})
+
+
+class TreatmentQueueSerializer(serializers.ModelSerializer):
+    """Compact treatment shape used by the live queue board."""
+    class Meta:
+        model = Treatment
+        fields = ['id', 'patient', 'doctor', 'appointment', 'follow_up_required', 'created_at']
+
+
+class TreatmentHistoryQuerySerializer(serializers.Serializer):
+    since = serializers.DateField(required=False)
+    patient = serializers.IntegerField(required=False)
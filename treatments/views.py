@@ -1,47 +1,75 @@
-from rest_framework import viewsets, permissions, status
+from datetime import datetime, timedelta
+from rest_framework import viewsets, permissions
 from rest_framework.decorators import action
-from rest_framework.response import Response
 from rest_framework.exceptions import ValidationError
 from django.utils import timezone
 from .models import Treatment
-from .serializers import TreatmentSerializer
+from .serializers import TreatmentSerializer, TreatmentQueueSerializer, TreatmentHistoryQuerySerializer
 from .permissions import IsDoctor
 from patients.models import Patient
+from appointments.models import DoctorLoad
 from core.mixins import CacheResponseMixin, CacheInvalidationMixin
+from core.cache import TREATMENTS, APPOINTMENTS, PATIENTS
+from core.events import queue_event, publish_queue_events, PATIENT_SEEN, TREATMENT_CREATED
+from patients.serializers import PatientQueueSerializer
+from appointments.views import status_event
+
+HISTORY_PARAMS = ('since', 'patient')
+
+
+def day_range(day):
+    """Start and end of ``day``, as a range the created_at indexes can serve."""
+    start = timezone.make_aware(datetime.combine(day, datetime.min.time()))
+    return start, start + timedelta(days=1)
+
 
 class TreatmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.ModelViewSet):
-    queryset = Treatment.objects.select_related('patient', 'doctor', 'appointment').all()
+    queryset = Treatment.objects.select_related('patient__assigned_doctor', 'doctor', 'appointment').all()
     serializer_class = TreatmentSerializer
     permission_classes = [permissions.IsAuthenticated, IsDoctor]
     cache_key_prefix = "treatment"
+    cache_namespaces_to_invalidate = (TREATMENTS, APPOINTMENTS, PATIENTS)
+    cache_patient_id_attr = 'patient_id'
 
     def get_queryset(self):
         qs = super().get_queryset()
         user = self.request.user
         if getattr(user, 'role', None) == 'doctor':
-            from django.utils import timezone
-            today = timezone.now().date()
-            qs = qs.filter(doctor=user, created_at__date=today)
+            qs = qs.filter(doctor=user)
+        if self.is_history_request():
+            qs = self.filter_history(qs)
+        elif getattr(user, 'role', None) == 'doctor' and self.action != 'retrieve':
+            # Without history filters doctors work on today's treatments only.
+            start, end = day_range(timezone.now().date())
+            qs = qs.filter(created_at__gte=start, created_at__lt=end)
         return qs
 
-    def get_cache_keys_to_invalidate(self, instance):
-        keys = ["all_treatments", "all_appointments", "appointments_list_all"]
-        if instance.doctor_id:
-            keys.append(f"appointments_list_doctor_{instance.doctor_id}")
-            
-        today = timezone.now().date().isoformat()
-        keys.append(f"treatments_today_{today}")
-        
-        if instance.appointment:
-            self._add_appointment_cache_keys(instance.appointment, keys)
-        return keys
+    def is_history_request(self):
+        # ``?since=`` and ``?patient=`` turn the list into a history view,
+        # paginated newest first along the (doctor, created_at) index.
+        return self.action == 'list' and any(name in self.request.query_params for name in HISTORY_PARAMS)
+
+    def filter_history(self, qs):
+        params = TreatmentHistoryQuerySerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        filters = params.validated_data
+        if 'since' in filters:
+            qs = qs.filter(created_at__gte=day_range(filters['since'])[0])
+        if 'patient' in filters:
+            qs = qs.filter(patient_id=filters['patient'])
+        return qs
+
+    def get_cache_scope(self, request):
+        user = request.user
+        if getattr(user, 'role', None) != 'doctor':
+            return '_all'
+        if self.is_history_request() or self.action == 'retrieve':
+            return f"_doctor_{user.id}"
+        return f"_doctor_{user.id}_{timezone.now().date().isoformat()}"
 
-    def _add_appointment_cache_keys(self, appt, keys):
-        if appt.appointment_date:
-            date_str = appt.appointment_date.date().isoformat()
-            if appt.doctor_id:
-                keys.append(f"appointments_today_doctor_{appt.doctor_id}_{date_str}")
-            keys.append(f"appointments_today_all_{date_str}")
+    def get_list_cache_key(self, request):
+        mode = '_history' if self.is_history_request() else ''
+        return f"treatments_list{mode}{self.get_cache_scope(request)}{self.get_query_cache_suffix(request)}"
 
     def perform_create(self, serializer):
         initial = serializer.validated_data.pop('_resolved_initial_appointment', None)
@@ -54,27 +82,55 @@ class TreatmentViewSet(CacheResponseMixin, CacheInvalidationMixin, viewsets.Mode
             appointment=initial
         )
 
-        self._update_related_models(instance, initial)
+        events = self._update_related_models(instance, initial)
         self._invalidate_cache(instance)
+        publish_queue_events(
+            queue_event(TREATMENT_CREATED, {'treatment': TreatmentQueueSerializer(instance).data}, instance.doctor_id),
+            *events
+        )
 
     def _update_related_models(self, instance, appointment):
+        events = []
         if instance.follow_up_required is False and appointment.status != 'completed':
+            load_key = appointment.load_key
             appointment.status = 'completed'
             appointment.save(update_fields=['status'])
+            DoctorLoad.track(load_key, appointment.load_key, 'pending')
+            events.append(status_event(appointment))
 
         Patient.objects.filter(pk=instance.patient_id).update(is_seen=True)
+        patient = instance.patient
+        if not patient.is_seen:
+            DoctorLoad.track(patient.load_key, None, 'unseen')
+            patient.is_seen = True
+            events.append(queue_event(PATIENT_SEEN, {'patient': PatientQueueSerializer(patient).data}, patient.assigned_doctor_id))
+        return events
 
     def perform_update(self, serializer):
         instance = serializer.save()
         if instance.follow_up_required is False and instance.appointment and instance.appointment.status != 'completed':
+            load_key = instance.appointment.load_key
             instance.appointment.status = 'completed'
             instance.appointment.save(update_fields=['status'])
+            DoctorLoad.track(load_key, instance.appointment.load_key, 'pending')
+            publish_queue_events(status_event(instance.appointment))
             
         self._invalidate_cache(instance)
         
+    def get_today_cache_key(self, request, day):
+        user = request.user
+        if getattr(user, 'role', None) == 'doctor':
+            return f"treatments_today_doctor_{user.id}_{day.isoformat()}"
+        return f"treatments_today_all_{day.isoformat()}"
+
     @action(detail=False, methods=['get'])
     def today(self, request):
         today_date = timezone.now().date()
-        queryset = self.get_queryset().filter(created_at__date=today_date)
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+        cache_key = self.make_cache_key(self.get_today_cache_key(request, today_date))
+
+        def build_payload():
+            start, end = day_range(today_date)
+            queryset = self.get_queryset().filter(created_at__gte=start, created_at__lt=end).order_by('created_at')
+            return self.get_serializer(queryset, many=True).data
+
+        return self.cached_response(cache_key, build_payload, f"treatments.today user={request.user.id}")